@@ -1,150 +1,312 @@
 import os
 import logging
-from yt_dlp import YoutubeDL
-from mutagen.id3 import ID3, APIC
-from mutagen.easyid3 import EasyID3
-import requests
+import argparse
+import itertools
+import json
+import re
 import subprocess
-import shutil
-from pyfiglet import figlet_format
-from tqdm import tqdm
-import time
+import sys
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from StreamFlareCore import (AUDIO_FORMATS, BANNER, STORE_DIR, STORE_MAX_BYTES, VIDEO_FORMATS, Engine, MetricsRecorder,
+                             configure_scheduler, configure_store, download_batch, expand_links, get_file_size, iter_links)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-def sanitize_filename(filename):
-    return "".join(c if c.isalnum() or c in "._-" else "_" for c in filename)
+SIZE_PATTERN = r'(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?'
 
-def convert_file(input_file, output_file):
-    logging.info(f"Converting {input_file} to {output_file}")
-    subprocess.run(['ffmpeg', '-i', input_file, output_file], check=True)
-    os.remove(input_file)
+def parse_rate(value):
+    """Parse a rate like '500K' or '2.5M' (bytes per second, binary units)."""
+    match = re.fullmatch(SIZE_PATTERN + r'(?:/S)?', value.strip().upper())
+    if not match or float(match.group(1)) <= 0:
+        raise argparse.ArgumentTypeError(f"invalid rate {value!r}, use e.g. 500K or 2M")
+    return float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' ')
 
-def get_file_size(file_path):
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File {file_path} does not exist.")
-    return os.path.getsize(file_path) / (1024 * 1024)  # Convert bytes to megabytes
+def parse_size(value):
+    """Parse a size like '500M' or '20G' (bytes, binary units)."""
+    match = re.fullmatch(SIZE_PATTERN, value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}, use e.g. 500M or 20G")
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' '))
 
-def add_metadata_to_audio(file_path, title, artist, album=None, genre=None, year=None, thumbnail_url=None):
+def parse_count(value):
+    """Parse a whole number of at least 1, for counts of workers, connections and the like."""
     try:
-        audio = EasyID3(file_path)
-        audio['title'] = title
-        audio['artist'] = artist
-        if album:
-            audio['album'] = album
-        if genre:
-            audio['genre'] = genre
-        if year:
-            audio['date'] = year
-        audio.save()
-
-        if thumbnail_url:
-            thumbnail_data = requests.get(thumbnail_url).content
-            audio = ID3(file_path)
-            audio['APIC'] = APIC(
-                encoding=3,
-                mime='image/jpeg',
-                type=3,
-                desc='Cover',
-                data=thumbnail_data
-            )
-            audio.save()
-    except Exception as e:
-        logging.error(f"Failed to add metadata: {e}")
-
-def download_youtube(link, output_dir, file_format, custom_filename=None, retries=3):
-    for attempt in range(retries):
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"invalid count {value!r}, use a whole number of at least 1")
+    return count
+
+SERVER_PROGRESS_INTERVAL = 0.5  # seconds between status checks on /jobs/<id>/events
+SUBMIT_RESPONSE_WAIT = 2  # seconds POST /jobs waits for a playlist to be listed before answering
+MAX_REQUEST_BYTES = 1024 * 1024
+
+class JobServer:
+    """Local HTTP/JSON API over the download Engine, served from one asyncio event loop.
+
+        POST   /jobs              {"link" or "links", "format", "output_dir", "filename"} -> the new jobs
+                                  (a long playlist keeps being queued after the answer)
+        GET    /jobs              every job
+        GET    /jobs/<id>         one job
+        DELETE /jobs/<id>         cancel a job
+        POST   /jobs/<id>/pause   pause a job, keeping its partial download
+        POST   /jobs/<id>/resume  queue a paused job again
+        GET    /jobs/<id>/events  the job's status as JSON lines, streamed until it finishes
+        GET    /metrics           Prometheus-style totals
+
+    POST bodies must be sent as application/json, which web pages can only do with a CORS
+    preflight this server never answers, so a page open in the browser cannot queue
+    downloads. output_dir must be inside the server's own output directory unless
+    allow_any_output_dir is set.
+
+    The loop only parses requests and reports status. Downloads run on the Engine's
+    `workers` threads in this one warm process, so every job shares the imports, the
+    extractor list, the info cache and the pooled HTTP session.
+    """
+
+    def __init__(self, output_dir, file_format=None, workers=4, connections=1, retries=3, recorder=None,
+                 allow_any_output_dir=False):
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.allow_any_output_dir = allow_any_output_dir
+        self.recorder = recorder or MetricsRecorder()
+        self.engine = Engine(workers, retries, connections, on_metrics=self.recorder.record)
+
+    async def serve(self, port, host='127.0.0.1'):
+        import asyncio
+
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f"Job server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def submit(self, request):
+        """Queue a job for every video behind the request's link(s), returning the views of those queued so far."""
+        import asyncio
+
+        links = request.get('links') or [request.get('link')]
+        if not isinstance(links, list) or not all(isinstance(link, str) and link.strip() for link in links):
+            raise ValueError("Pass a 'link' string or a 'links' list")
+        file_format = request.get('format') or self.file_format
+        if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
+            raise ValueError(f"'format' must be one of {', '.join(AUDIO_FORMATS + VIDEO_FORMATS)}")
+        output_dir = self.resolve_output_dir(request.get('output_dir'))
+
+        queued = self.engine.submit_iter(links, output_dir, file_format, request.get('filename'))
+        jobs = []
+
+        def list_jobs():
+            for job in queued:
+                jobs.append(job)
+
+        # Listing playlists and channels needs the network, so it runs off the loop, and a long
+        # one carries on in the background after the answer
+        listing = asyncio.get_running_loop().run_in_executor(None, list_jobs)
+        await asyncio.wait([listing], timeout=SUBMIT_RESPONSE_WAIT)
+        return [job.to_dict() for job in list(jobs)]
+
+    def resolve_output_dir(self, output_dir):
+        """Return the directory a request asked for, relative to the server's output directory."""
+        if not output_dir:
+            return self.output_dir
+        if not isinstance(output_dir, str):
+            raise ValueError("'output_dir' must be a string")
+        root = os.path.realpath(self.output_dir)
+        output_dir = os.path.realpath(os.path.join(root, output_dir))
+        if not self.allow_any_output_dir and os.path.commonpath([root, output_dir]) != root:
+            raise ValueError(f"'output_dir' must be inside {root}")
+        return output_dir
+
+    async def handle(self, reader, writer):
+        """Serve one request per connection."""
         try:
-            logging.info(f"Downloading from link: {link}")
-
-            audio_formats = ['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus']
-            video_formats = ['mp4', 'mkv', 'avi', 'webm', 'mov', 'flv', 'wmv', '3gp']
-
-            if file_format in audio_formats:
-                ydl_opts = {
-                    'format': 'bestaudio/best',
-                    'outtmpl': os.path.join(output_dir, 'temp_audio.%(ext)s'),
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': file_format,
-                        'preferredquality': '192',
-                    }],
-                    'noplaylist': True,
-                }
-            elif file_format in video_formats:
-                ydl_opts = {
-                    'format': 'bestvideo+bestaudio/best',
-                    'outtmpl': os.path.join(output_dir, 'temp_video.%(ext)s'),
-                    'noplaylist': True,
-                }
-            else:
-                raise ValueError("Invalid format specified.")
-            
-            temp_files = [os.path.join(output_dir, f'temp_audio.{ext}') for ext in audio_formats] + \
-                         [os.path.join(output_dir, f'temp_video.{ext}') for ext in video_formats]
-            for temp_file in temp_files:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-
-            with YoutubeDL(ydl_opts) as ydl:
-                info_dict = ydl.extract_info(link, download=True)
-                video_title = info_dict.get('title', 'Unknown Title')
-                video_uploader = info_dict.get('uploader', 'Unknown Uploader')
-                thumbnail_url = info_dict.get('thumbnail')
-
-                temp_file = os.path.join(output_dir, f'temp_audio.{file_format}' if file_format in audio_formats else 'temp_video.webm')
-                final_file = os.path.join(output_dir, sanitize_filename(custom_filename) if custom_filename else sanitize_filename(f"{video_title}.{file_format}"))
-
-                if not os.path.exists(temp_file):
-                    raise FileNotFoundError(f"Temporary file {temp_file} does not exist.")
-
-                if file_format in video_formats:
-                    if file_format == 'mkv':
-                        if not os.path.exists(temp_file):
-                            raise FileNotFoundError(f"Temporary file {temp_file} does not exist.")
-                        os.rename(temp_file, final_file)
-                    else:
-                        temp_video_file = os.path.join(output_dir, 'temp_video.webm')
-                        if not os.path.exists(temp_video_file):
-                            raise FileNotFoundError(f"Temporary video file {temp_video_file} does not exist.")
-                        os.rename(temp_video_file, final_file)
-                else:
-                    if os.path.splitext(temp_file)[1][1:] != file_format:
-                        convert_file(temp_file, final_file)
-                    else:
-                        os.rename(temp_file, final_file)
-
-                if file_format in audio_formats:
-                    add_metadata_to_audio(final_file, video_title, video_uploader, thumbnail_url=thumbnail_url)
-
-            return final_file
-        except FileNotFoundError as fnf_error:
-            logging.error(f"Attempt {attempt + 1} failed: {fnf_error}")
-            if attempt < retries - 1:
-                time.sleep(5)
-            else:
-                raise
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) != 3 or not headers.get('content-length', '0').isdigit():
+                await self.respond(writer, 400, {'error': "Malformed request"})
+                return
+            length = int(headers.get('content-length', '0'))
+            if length > MAX_REQUEST_BYTES:
+                await self.respond(writer, 413, {'error': "Request body too large"})
+                return
+            body = await reader.readexactly(length) if length else b''
+            await self.route(request_line[0], urlsplit(request_line[1]).path, headers, body, writer)
+        except ConnectionError:
+            pass
         except Exception as e:
-            logging.error(f"Attempt {attempt + 1} failed: {e}")
-            if attempt < retries - 1:
-                time.sleep(5)
-            else:
-                raise
+            logging.error(f"Job server request failed: {e}")
+            try:
+                await self.respond(writer, 500, {'error': str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, headers, body, writer):
+        parts = [part for part in path.split('/') if part]
+        if method == 'POST' and headers.get('content-type', '').split(';')[0].strip().lower() != 'application/json':
+            return await self.respond(writer, 415, {'error': "POST requests must be sent as application/json"})
+        if parts == ['metrics'] and method == 'GET':
+            return await self.respond(writer, 200, self.recorder.render(), 'text/plain; version=0.0.4')
+        if parts == ['jobs']:
+            if method == 'GET':
+                return await self.respond(writer, 200, [job.to_dict() for job in self.engine.snapshot()])
+            if method == 'POST':
+                try:
+                    views = await self.submit(json.loads(body or b'{}'))
+                except (ValueError, AttributeError, OSError) as e:
+                    return await self.respond(writer, 400, {'error': str(e)})
+                return await self.respond(writer, 201, views)
+            return await self.respond(writer, 405, {'error': "Use GET or POST"})
+
+        job = None
+        if parts[:1] == ['jobs'] and len(parts) in (2, 3) and parts[1].isdigit():
+            job = self.engine.get(int(parts[1]))
+        action = parts[2] if len(parts) == 3 else None
+        if job is None or action not in (None, 'events', 'pause', 'resume'):
+            return await self.respond(writer, 404, {'error': "Not found"})
+        if action == 'events' and method == 'GET':
+            return await self.stream_events(job, writer)
+        if action is None and method == 'GET':
+            return await self.respond(writer, 200, job.to_dict())
+        requests = {(None, 'DELETE'): self.engine.cancel, ('pause', 'POST'): self.engine.pause, ('resume', 'POST'): self.engine.resume}
+        if (action, method) not in requests:
+            return await self.respond(writer, 405, {'error': "Method not allowed"})
+        if not requests[action, method](job):
+            return await self.respond(writer, 409, {'error': f"Job is {job.status}"})
+        return await self.respond(writer, 200, job.to_dict())
+
+    async def stream_events(self, job, writer):
+        """Write the job's view as a JSON line whenever it changes, until the job finishes."""
+        import asyncio
 
-def progress_bar(iterable, total, desc="Processing"):
-    for i, item in enumerate(tqdm(iterable, desc=desc, total=total, unit='item')):
-        yield item
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nCache-Control: no-cache\r\n'
+                     b'Connection: close\r\n\r\n')
+        last = None
+        while True:
+            view = job.to_dict()
+            if view != last:
+                writer.write((json.dumps(view) + '\n').encode())
+                await writer.drain()
+                last = view
+            if job.finished:
+                return
+            await asyncio.sleep(SERVER_PROGRESS_INTERVAL)
 
-def main():
+    async def respond(self, writer, status, payload, content_type='application/json'):
+        body = payload if isinstance(payload, str) else json.dumps(payload, indent=2) + '\n'
+        body = body.encode()
+        writer.write(f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+
+def report_results(results, open_after_download=False):
+    """Print each finished job of a batch, returning the number of failed links."""
+    from tqdm import tqdm
+
+    failures = 0
+    for link, output_file, error in results:
+        if error:
+            failures += 1
+            logging.error(f"An error occurred while processing {link}: {error}")
+            continue
+        file_size = get_file_size(output_file)
+        logging.info(f"Downloaded and saved as {output_file} ({file_size:.2f} MB)")
+        tqdm.write(f"Downloaded and saved as {output_file} ({file_size:.2f} MB)")
+
+        if open_after_download:
+            subprocess.run(['start', '', output_file], shell=True)
+    return failures
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="StreamFlare - a simple youtube downloader, for terminals. "
+                    "Run without --format for the interactive prompts.")
+    parser.add_argument('links', nargs='*', help="links to download; playlists and channels are expanded")
+    parser.add_argument('-f', '--format', choices=AUDIO_FORMATS + VIDEO_FORMATS, help="output format (enables non-interactive mode)")
+    parser.add_argument('-i', '--input', help="read links from this file ('-' for stdin), one per line or comma-separated")
+    parser.add_argument('-o', '--output-dir', default=os.getcwd(), help="output directory (default: current directory)")
+    parser.add_argument('--filename', help="custom output filename")
+    parser.add_argument('-w', '--workers', type=parse_count, default=4, help="concurrent downloads (default: 4)")
+    parser.add_argument('-c', '--connections', type=parse_count, default=1, help="connections per download (default: 1)")
+    parser.add_argument('--limit-rate', type=parse_rate, metavar='RATE', help="cap the combined download speed, e.g. 500K or 2M (bytes/s)")
+    parser.add_argument('--max-per-host', type=parse_count, metavar='N', help="at most N downloads at once from the same site")
+    parser.add_argument('--proxy', action='append', metavar='URL',
+                        help="proxy to download through; repeat it (or separate with commas) for a rotating pool")
+    parser.add_argument('--max-per-proxy', type=parse_count, metavar='N', help="at most N downloads at once through each proxy")
+    parser.add_argument('--store-dir', default=STORE_DIR, metavar='DIR',
+                        help=f"keep finished files here and link outputs to them, so repeats cost no download (default: {STORE_DIR})")
+    parser.add_argument('--store-size', type=parse_size, default=STORE_MAX_BYTES, metavar='SIZE',
+                        help="evict the least recently used stored files beyond SIZE, e.g. 20G; 0 turns the store off (default: 10G)")
+    parser.add_argument('--metrics-file', help="append per-job timings to this file as JSON lines")
+    parser.add_argument('--prometheus-file', help="keep Prometheus-style metric totals in this file")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus-style metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--no-banner', action='store_true', help="don't print the ASCII banner before the interactive prompts")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="run as a job server with an HTTP/JSON API on http://127.0.0.1:PORT (-f sets the default format)")
+    parser.add_argument('--host', default='127.0.0.1', help="address for --serve to listen on (default: 127.0.0.1)")
+    parser.add_argument('--allow-any-output-dir', action='store_true',
+                        help="let --serve clients save anywhere, not only inside --output-dir")
+    return parser.parse_args(argv)
+
+def read_lines(path):
+    """Lazily yield lines from a file, or from stdin when path is '-'."""
+    if path == '-':
+        yield from sys.stdin
+        return
+    with open(path, encoding='utf-8') as f:
+        yield from f
+
+def run_non_interactive(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    lines = itertools.chain(args.links, read_lines(args.input)) if args.input else args.links
+    links = expand_links(iter_links(lines))
+    recorder = MetricsRecorder(args.metrics_file, args.prometheus_file)
+    if args.metrics_port:
+        recorder.serve(args.metrics_port)
+    results = download_batch(links, args.output_dir, args.format, args.filename, args.workers, connections=args.connections,
+                             on_metrics=recorder.record)
+    return 1 if report_results(results) else 0
+
+def run_server(args):
+    import asyncio
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    recorder = MetricsRecorder(args.metrics_file, args.prometheus_file)
+    if args.metrics_port:
+        recorder.serve(args.metrics_port)
+    server = JobServer(args.output_dir, args.format, args.workers, args.connections, recorder=recorder,
+                       allow_any_output_dir=args.allow_any_output_dir)
     try:
-        ascii_art = figlet_format("StreamFlare", font='small')
-        print(ascii_art)
-    except Exception as e:
-        logging.error(f"Error generating ASCII art: {e}")
-        print("StreamFlare")
+        asyncio.run(server.serve(args.serve, args.host))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    proxies = [proxy.strip() for value in args.proxy or [] for proxy in value.split(',')]
+    configure_scheduler(args.limit_rate, args.max_per_host, proxies, args.max_per_proxy)
+    configure_store(args.store_dir, args.store_size)
+    if args.serve:
+        return run_server(args)
+    if args.format:
+        return run_non_interactive(args)
 
-    formats = ['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus', 'mp4', 'mkv', 'avi', 'webm', 'mov', 'flv', 'wmv', '3gp']
+    if not args.no_banner:
+        print(BANNER)
+
+    formats = AUDIO_FORMATS + VIDEO_FORMATS
     file_format = input(f"What format do you want? ({', '.join(formats)}): ").strip().lower()
     if file_format not in formats:
         print(f"Choose one of the available formats: {', '.join(formats)}!")
@@ -165,20 +327,21 @@ def main():
     custom_filename = input("Enter a custom filename (optional): ").strip()
     open_after_download = input("Open file after download? (yes/no): ").strip().lower() == "yes"
     
-    total_links = len(links)
-    for link in progress_bar(links, total_links, desc="Downloading"):
-        try:
-            output_file = download_youtube(link.strip(), output_dir, file_format, custom_filename)
-            if output_file:
-                file_size = get_file_size(output_file)
-                logging.info(f"Downloaded and saved as {output_file} ({file_size:.2f} MB)")
-                print(f"Downloaded and saved as {output_file} ({file_size:.2f} MB)")
-                
-                if open_after_download:
-                    subprocess.run(['start', '', output_file], shell=True)
-                
-        except Exception as e:
-            logging.error(f"An error occurred while processing {link}: {e}")
+    workers = input("How many concurrent downloads? (leave blank for 4): ").strip()
+    try:
+        workers = int(workers) if workers else 4
+    except ValueError:
+        print("Number of concurrent downloads must be a whole number!")
+        return
+
+    connections = input("How many connections per download? (leave blank for 1): ").strip()
+    try:
+        connections = int(connections) if connections else 1
+    except ValueError:
+        print("Number of connections must be a whole number!")
+        return
+
+    report_results(download_batch(links, output_dir, file_format, custom_filename, workers, connections=connections), open_after_download)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,1823 @@
+"""StreamFlare's download engine, shared by the CLI (StreamFlare.py) and the UI (StreamFlareUI.py).
+
+download_youtube() runs one link and download_batch() pipelines many. Engine queues Jobs on a
+worker pool and reports their progress through an on_event callback.
+"""
+# yt_dlp, mutagen, requests, tqdm and the process pool are imported where they are first
+# needed: they make up most of the startup time, and many invocations (--help, the
+# interactive prompts, archive hits) never touch some of them.
+import os
+import logging
+import subprocess
+import shutil
+import time
+import random
+import tempfile
+import queue
+import threading
+import hashlib
+import sqlite3
+import json
+import gzip
+import base64
+import functools
+import contextlib
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Pre-rendered figlet_format("StreamFlare", font='small'), so printing it costs nothing
+BANNER = '\n'.join((
+    r" ___ _                      ___ _",
+    r"/ __| |_ _ _ ___ __ _ _ __ | __| |__ _ _ _ ___",
+    r"\__ \  _| '_/ -_) _` | '  \| _|| / _` | '_/ -_)",
+    r"|___/\__|_| \___\__,_|_|_|_|_| |_\__,_|_| \___|",
+)) + '\n'
+
+def sanitize_filename(filename):
+    return "".join(c if c.isalnum() or c in "._-" else "_" for c in filename)
+
+# Target container -> (video codecs it can hold as-is, audio codecs it can hold as-is,
+# video encoder, audio encoder). None means the container accepts any codec.
+CONTAINER_CODECS = {
+    'mp3': (set(), {'mp3'}, None, 'libmp3lame'),
+    'flac': (set(), {'flac'}, None, 'flac'),
+    'm4a': (set(), {'aac', 'alac'}, None, 'aac'),
+    'wav': (set(), {'pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le'}, None, 'pcm_s16le'),
+    'aac': (set(), {'aac'}, None, 'aac'),
+    'ogg': (set(), {'vorbis', 'opus', 'flac'}, None, 'libvorbis'),
+    'opus': (set(), {'opus'}, None, 'libopus'),
+    'mp4': ({'h264', 'hevc', 'av1', 'mpeg4'}, {'aac', 'mp3', 'ac3', 'alac'}, 'libx264', 'aac'),
+    'mkv': (None, None, 'libx264', 'aac'),
+    'webm': ({'vp8', 'vp9', 'av1'}, {'opus', 'vorbis'}, 'libvpx-vp9', 'libopus'),
+    'mov': ({'h264', 'hevc', 'mpeg4', 'prores', 'mjpeg'}, {'aac', 'alac', 'mp3', 'pcm_s16le'}, 'libx264', 'aac'),
+    'avi': ({'mpeg4', 'h264', 'mjpeg', 'msmpeg4v3'}, {'mp3', 'ac3', 'pcm_s16le'}, 'mpeg4', 'libmp3lame'),
+    'flv': ({'h264', 'flv1'}, {'aac', 'mp3'}, 'libx264', 'aac'),
+    'wmv': ({'wmv1', 'wmv2'}, {'wmav1', 'wmav2'}, 'wmv2', 'wmav2'),
+    '3gp': ({'h263', 'h264', 'mpeg4'}, {'aac', 'amr_nb'}, 'libx264', 'aac'),
+}
+ANNEXB_CONTAINERS = {'avi'}
+LOSSY_AUDIO_ENCODERS = {'libmp3lame', 'aac', 'libvorbis', 'libopus', 'wmav2'}
+AUDIO_BITRATE = '192k'
+
+class CpuAccount:
+    """CPU time a JobMetrics stage spends off its own thread: in pool threads and in child processes."""
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.child_cpu = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, cpu=0.0, child_cpu=0.0):
+        with self.lock:
+            self.cpu += cpu
+            self.child_cpu += child_cpu
+
+# Per thread, the accounts of the stages it is running, innermost last
+_cpu_accounts = threading.local()
+
+def current_cpu_account():
+    """Return the account of the stage running on this thread, or None."""
+    stack = getattr(_cpu_accounts, 'stack', None)
+    return stack[-1] if stack else None
+
+def run_tool(command, capture_output=False):
+    """subprocess.run(command, check=True) for ffmpeg/ffprobe, charging the child's CPU time to the running stage.
+
+    The child is reaped with os.wait4, which reports its own CPU time; RUSAGE_CHILDREN
+    would also count the children of every other job in the process. Output goes through
+    temporary files so nothing waits on a full pipe. Returns stdout as text with capture_output.
+    """
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=stdout if capture_output else None,
+                                   stderr=stderr if capture_output else None)
+        try:
+            if hasattr(os, 'wait4'):
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                account = current_cpu_account()
+                if account:
+                    account.add(child_cpu=usage.ru_utime + usage.ru_stime)
+            else:
+                process.wait()  # child CPU time is simply not reported here
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        output = errors = None
+        if capture_output:
+            stdout.seek(0)
+            stderr.seek(0)
+            output, errors = stdout.read().decode(errors='replace'), stderr.read().decode(errors='replace')
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output, errors)
+        return output
+
+def probe_streams(input_file):
+    """Return {'video': codec, 'audio': codec} for the first stream of each type in input_file."""
+    output = run_tool(['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', input_file],
+                      capture_output=True)
+    codecs = {}
+    for stream in json.loads(output).get('streams', []):
+        codec_type = stream.get('codec_type')
+        if codec_type in ('video', 'audio') and codec_type not in codecs:
+            codecs[codec_type] = stream.get('codec_name')
+    return codecs
+
+def plan_conversion(codecs, file_format, audio_only=False):
+    """Build the ffmpeg stream arguments that copy every compatible stream and re-encode the rest."""
+    video_ok, audio_ok, video_encoder, audio_encoder = CONTAINER_CODECS[file_format]
+    args = []
+    if 'video' in codecs and not audio_only:
+        args += ['-map', '0:v:0']
+        if video_ok is None or codecs['video'] in video_ok:
+            args += ['-c:v', 'copy']
+            if file_format in ANNEXB_CONTAINERS and codecs['video'] in ('h264', 'hevc'):
+                # Streams from mp4/mkv sources carry length-prefixed NAL units that AVI cannot hold
+                args += ['-bsf:v', f"{codecs['video']}_mp4toannexb"]
+        else:
+            args += ['-c:v', video_encoder]
+    else:
+        args.append('-vn')
+    if 'audio' in codecs:
+        args += ['-map', '0:a:0']
+        if audio_ok is None or codecs['audio'] in audio_ok:
+            args += ['-c:a', 'copy']
+        else:
+            args += ['-c:a', audio_encoder]
+            if audio_encoder in LOSSY_AUDIO_ENCODERS:
+                args += ['-b:a', AUDIO_BITRATE]
+    return args
+
+def convert_file(input_file, output_file, audio_only=False):
+    file_format = os.path.splitext(output_file)[1][1:].lower()
+    args = plan_conversion(probe_streams(input_file), file_format, audio_only)
+    logging.info(f"Converting {input_file} to {output_file}: {' '.join(args)}")
+    run_tool(['ffmpeg', '-y', '-loglevel', 'error', '-i', input_file] + args + [output_file])
+    os.remove(input_file)
+
+def get_file_size(file_path):
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File {file_path} does not exist.")
+    return os.path.getsize(file_path) / (1024 * 1024)  # Convert bytes to megabytes
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Return a process-wide pooled requests.Session (recreated after a fork)."""
+    global _http_session, _http_session_pid
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session, _http_session_pid = session, os.getpid()
+        return _http_session
+
+@functools.lru_cache(maxsize=32)
+def fetch_cover_art(url):
+    """Fetch cover art once per URL, returning (data, mime type)."""
+    response = get_http_session().get(url, timeout=30)
+    response.raise_for_status()
+    mime = response.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+    return response.content, mime
+
+def add_metadata_to_audio(file_path, title, artist, album=None, genre=None, year=None, thumbnail_url=None):
+    """Write tags and cover art with the container's native tag format, saving the file once."""
+    import mutagen
+    from mutagen import MutagenError
+    from mutagen.aac import AAC
+    from mutagen.flac import FLAC, Picture
+    from mutagen.id3 import APIC, TALB, TCON, TDRC, TIT2, TPE1
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4, MP4Cover
+    from mutagen.wave import WAVE
+
+    audio = mutagen.File(file_path)
+    if audio is None:
+        raise MutagenError(f"Unrecognised audio file {file_path}")
+    if isinstance(audio, AAC):
+        logging.warning(f"Skipping metadata for {file_path}: raw AAC streams cannot hold tags")
+        return
+
+    tags = {'title': title, 'artist': artist, 'album': album, 'genre': genre, 'date': year}
+    tags = {key: value for key, value in tags.items() if value}
+    cover_data, cover_mime = fetch_cover_art(thumbnail_url) if thumbnail_url else (None, None)
+
+    if isinstance(audio, (MP3, WAVE)):
+        if audio.tags is None:
+            audio.add_tags()
+        frames = {'title': TIT2, 'artist': TPE1, 'album': TALB, 'genre': TCON, 'date': TDRC}
+        for key, value in tags.items():
+            audio.tags.add(frames[key](encoding=3, text=value))
+        if cover_data:
+            audio.tags.delall('APIC')
+            audio.tags.add(APIC(encoding=3, mime=cover_mime, type=3, desc='Cover', data=cover_data))
+    elif isinstance(audio, MP4):
+        atoms = {'title': '\xa9nam', 'artist': '\xa9ART', 'album': '\xa9alb', 'genre': '\xa9gen', 'date': '\xa9day'}
+        for key, value in tags.items():
+            audio[atoms[key]] = [value]
+        if cover_data:
+            image_format = MP4Cover.FORMAT_PNG if cover_mime == 'image/png' else MP4Cover.FORMAT_JPEG
+            audio['covr'] = [MP4Cover(cover_data, imageformat=image_format)]
+    else:
+        # FLAC and Ogg (Vorbis/Opus) files use Vorbis comments
+        for key, value in tags.items():
+            audio[key] = value
+        if cover_data:
+            picture = Picture()
+            picture.type = 3
+            picture.mime = cover_mime
+            picture.desc = 'Cover'
+            picture.data = cover_data
+            if isinstance(audio, FLAC):
+                audio.clear_pictures()
+                audio.add_picture(picture)
+            else:
+                audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+    audio.save()
+
+AUDIO_FORMATS = ['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus']
+VIDEO_FORMATS = ['mp4', 'mkv', 'avi', 'webm', 'mov', 'flv', 'wmv', '3gp']
+
+_active_job_dirs = set()
+_active_job_dirs_lock = threading.Lock()
+
+def stable_job_dir(output_dir, link, file_format):
+    key = hashlib.sha1(f"{link}|{file_format}".encode()).hexdigest()[:16]
+    return os.path.join(output_dir, f'.streamflare-{key}')
+
+def make_job_dir(output_dir, link=None, file_format=None):
+    """Return a scratch directory inside output_dir, so the final move is a same-filesystem rename.
+
+    Jobs for a link get a stable directory, so partial downloads left by a failed attempt
+    (or an earlier run) are resumed instead of restarted. A second concurrent job for the
+    same link and format falls back to a throwaway directory.
+    """
+    if link:
+        job_dir = stable_job_dir(output_dir, link, file_format)
+        with _active_job_dirs_lock:
+            if job_dir not in _active_job_dirs:
+                _active_job_dirs.add(job_dir)
+                os.makedirs(job_dir, exist_ok=True)
+                return job_dir
+    return tempfile.mkdtemp(prefix='.streamflare-', dir=output_dir)
+
+def release_job_dir(job_dir, keep_partial=False):
+    """Delete a scratch directory, or with keep_partial only when nothing worth resuming is in it."""
+    with _active_job_dirs_lock:
+        _active_job_dirs.discard(job_dir)
+    if keep_partial and os.path.isdir(job_dir) and os.listdir(job_dir):
+        return
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+def discard_partial(output_dir, link, file_format):
+    """Delete what a failed or stopped job left to resume, unless another job is using it."""
+    job_dir = stable_job_dir(output_dir, link, file_format)
+    with _active_job_dirs_lock:
+        if job_dir in _active_job_dirs:
+            return
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+def find_temp_file(job_dir, stem):
+    candidates = [name for name in os.listdir(job_dir) if os.path.splitext(name)[0] == stem]
+    if not candidates:
+        raise FileNotFoundError(f"Temporary file {os.path.join(job_dir, stem)}.* does not exist.")
+    return os.path.join(job_dir, candidates[0])
+
+def save_segments(state_file, segments):
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(segments, f)
+    os.replace(state_file + '.tmp', state_file)
+
+def segmented_download(url, dest, connections=4, headers=None, chunk_size=1024 * 1024, timeout=30, progress_hooks=(), proxy=None):
+    """Download url into dest over up to `connections` parallel HTTP Range requests.
+
+    Progress is tracked per segment in a `dest.segments.json` sidecar, so a download that
+    fails part-way is resumed from where each segment stopped on the next call. Servers
+    that do not honour Range requests get a plain single-connection download.
+    progress_hooks are called like yt-dlp progress hooks.
+    """
+    state_file = dest + '.segments.json'
+    session = get_http_session()
+    proxies = {'http': proxy, 'https': proxy} if proxy else None
+    headers = headers or {}
+
+    segments = None
+    if os.path.exists(state_file) and os.path.exists(dest):
+        with open(state_file) as f:
+            segments = json.load(f)
+    if segments is None:
+        with session.get(url, headers={**headers, 'Range': 'bytes=0-0'}, stream=True, timeout=timeout, proxies=proxies) as probe:
+            content_range = probe.headers.get('Content-Range', '')
+            # Even the first byte is out of range only when the resource is empty
+            empty = probe.status_code == 416 and content_range in ('', 'bytes */0')
+            if not empty:
+                probe.raise_for_status()
+            if empty:
+                total = 0
+            elif probe.status_code != 206 or '/' not in content_range or content_range.endswith('/*'):
+                logging.info(f"{url} does not support range requests, downloading over one connection")
+                with session.get(url, headers=headers, stream=True, timeout=timeout, proxies=proxies) as response, \
+                        open(dest, 'wb') as f:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                return dest
+            else:
+                total = int(content_range.rsplit('/', 1)[1])
+        if total == 0:
+            open(dest, 'wb').close()
+            return dest
+
+        connections = max(1, min(connections, total // chunk_size or 1))
+        step = -(-total // connections)
+        # [first byte, last byte, bytes already written]
+        segments = [[start, min(start + step, total) - 1, 0] for start in range(0, total, step)]
+        with open(dest, 'wb') as f:
+            f.truncate(total)
+        save_segments(state_file, segments)
+
+    lock = threading.Lock()
+    account = current_cpu_account()
+
+    def progress_snapshot():
+        return {'status': 'downloading', 'filename': dest, 'total_bytes': segments[-1][1] + 1,
+                'downloaded_bytes': sum(done for _, _, done in segments)}
+
+    def report_progress(progress):
+        # Never called with lock held: the throttle hook sleeps, and would hold up every segment
+        for hook in progress_hooks:
+            hook(progress)
+
+    # Start from what an earlier attempt left behind
+    report_progress(progress_snapshot())
+
+    def fetch_segment(segment):
+        cpu = time.thread_time()
+        try:
+            transfer_segment(segment)
+        finally:
+            if account:
+                account.add(cpu=time.thread_time() - cpu)
+
+    def transfer_segment(segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+        with session.get(url, headers={**headers, 'Range': f'bytes={start + done}-{end}'}, stream=True, timeout=timeout,
+                         proxies=proxies) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Server ignored the range request for {url}")
+            with open(dest, 'r+b') as f:
+                f.seek(start + done)
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        save_segments(state_file, segments)
+                        progress = progress_snapshot()
+                    report_progress(progress)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            for future in [pool.submit(fetch_segment, segment) for segment in segments]:
+                future.result()
+    finally:
+        with lock:
+            save_segments(state_file, segments)
+
+    if any(start + done <= end for start, end, done in segments):
+        raise IOError(f"Incomplete download of {url}")
+    os.remove(state_file)
+    return dest
+
+ARCHIVE_NAME = '.streamflare-archive.sqlite3'
+_extractor_classes = None
+
+def match_extractor(link):
+    """Return (extractor class, temporary id) for a link without any network access."""
+    global _extractor_classes
+    if _extractor_classes is None:
+        from yt_dlp.extractor import gen_extractor_classes
+
+        _extractor_classes = list(gen_extractor_classes())
+    for ie in _extractor_classes:
+        if ie.suitable(link):
+            return ie, ie.get_temp_id(link)
+    return None, None
+
+def get_video_key(link):
+    """Return the archive key ("<extractor> <id>") for a link without any network access."""
+    ie, video_id = match_extractor(link)
+    return f"{ie.ie_key().lower()} {video_id}" if ie and video_id else None
+
+def file_checksum(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_archive(output_dir):
+    conn = sqlite3.connect(os.path.join(output_dir, ARCHIVE_NAME), timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS downloads ("
+        "video_key TEXT NOT NULL, file_format TEXT NOT NULL, path TEXT NOT NULL, "
+        "size INTEGER NOT NULL, sha256 TEXT NOT NULL, downloaded_at REAL NOT NULL, "
+        "PRIMARY KEY (video_key, file_format))"
+    )
+    return conn
+
+def archive_lookup(output_dir, video_key, file_format):
+    """Return the archived file for video_key/file_format if it is still on disk, else None."""
+    conn = open_archive(output_dir)
+    try:
+        row = conn.execute(
+            "SELECT path, size FROM downloads WHERE video_key = ? AND file_format = ?",
+            (video_key, file_format),
+        ).fetchone()
+        if row is None:
+            return None
+        path, size = row
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            return path
+        # The file was moved, deleted or rewritten since it was archived
+        with conn:
+            conn.execute("DELETE FROM downloads WHERE video_key = ? AND file_format = ?", (video_key, file_format))
+        return None
+    finally:
+        conn.close()
+
+def archive_record(output_dir, video_key, file_format, file_path, checksum=None):
+    conn = open_archive(output_dir)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)",
+                (video_key, file_format, os.path.abspath(file_path), os.path.getsize(file_path),
+                 checksum or file_checksum(file_path), time.time()),
+            )
+    finally:
+        conn.close()
+
+# yt-dlp codec strings (e.g. 'avc1.64001F', 'mp4a.40.2') -> ffmpeg codec names used in CONTAINER_CODECS
+CODEC_ALIASES = {
+    'avc1': 'h264', 'avc3': 'h264', 'hev1': 'hevc', 'hvc1': 'hevc', 'vp09': 'vp9', 'av01': 'av1',
+    'mp4v': 'mpeg4', 'mp4a': 'aac', 'ac-3': 'ac3', 'ec-3': 'eac3',
+}
+
+def normalize_codec(codec):
+    if not codec or codec == 'none':
+        return None
+    name = codec.split('.')[0].lower()
+    return CODEC_ALIASES.get(name, name)
+
+def format_selector(file_format):
+    """Return a yt-dlp format selector that prefers formats which can be saved as file_format without transcoding.
+
+    Formats are ranked first by whether their codecs fit the target container, then by whether
+    the downloaded container already is the target, and finally by yt-dlp's own quality order.
+    """
+    video_ok, audio_ok, _, _ = CONTAINER_CODECS[file_format]
+
+    def fits(codec, allowed):
+        codec = normalize_codec(codec)
+        return codec is not None and (allowed is None or codec in allowed)
+
+    def select(ctx):
+        formats = list(enumerate(ctx.get('formats', [])))
+        audio_only = [(i, f) for i, f in formats if normalize_codec(f.get('acodec')) and not normalize_codec(f.get('vcodec'))]
+        video_only = [(i, f) for i, f in formats if normalize_codec(f.get('vcodec')) and not normalize_codec(f.get('acodec'))]
+        combined = [(i, f) for i, f in formats if normalize_codec(f.get('vcodec')) and normalize_codec(f.get('acodec'))]
+
+        if file_format in AUDIO_FORMATS:
+            candidates = audio_only or combined
+            if candidates:
+                yield max(candidates, key=lambda item: (fits(item[1].get('acodec'), audio_ok),
+                                                        item[1].get('ext') == file_format, item[0]))[1]
+            return
+
+        if video_only and audio_only:
+            video = max(video_only, key=lambda item: (fits(item[1].get('vcodec'), video_ok), item[0]))[1]
+            audio = max(audio_only, key=lambda item: (fits(item[1].get('acodec'), audio_ok), item[0]))[1]
+            direct = fits(video.get('vcodec'), video_ok) and fits(audio.get('acodec'), audio_ok)
+            yield {
+                'format_id': f"{video['format_id']}+{audio['format_id']}",
+                # Merge straight into the target when both streams fit, else into mkv for convert_file
+                'ext': file_format if direct else 'mkv',
+                'requested_formats': [video, audio],
+                'protocol': f"{video.get('protocol')}+{audio.get('protocol')}",
+            }
+        elif combined:
+            yield max(combined, key=lambda item: (fits(item[1].get('vcodec'), video_ok) and fits(item[1].get('acodec'), audio_ok),
+                                                  item[1].get('ext') == file_format, item[0]))[1]
+
+    return select
+
+class JobMetrics:
+    """Per-job stage timings and counters.
+
+    Plain attributes only, so a copy can be filled in by a worker process and sent back;
+    the optional listener, called with (metrics, 'stage' | 'progress') as the job moves
+    along, stays behind in the parent.
+    """
+
+    def __init__(self, link=None, file_format=None):
+        self.link = link
+        self.file_format = file_format
+        self.started = time.time()
+        self.finished = None
+        self.status = None
+        self.error = None
+        self.bytes = 0
+        self.stages = {}   # stage -> {'wall': s, 'cpu': s, 'child_cpu': s}
+        self.retries = {}  # stage -> retries needed
+        # Live progress, for anyone watching the job while it runs
+        self.stage_name = None
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.listener = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['listener'] = None
+        return state
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a block as `name`.
+
+        cpu covers this thread and the threads it hands work to (segmented_download's
+        connections); child_cpu covers the ffmpeg/ffprobe runs started through run_tool.
+        Other jobs running in the same process are never counted.
+        """
+        self.stage_name = name
+        if self.listener:
+            self.listener(self, 'stage')
+        account = CpuAccount()
+        stack = _cpu_accounts.__dict__.setdefault('stack', [])
+        stack.append(account)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            stack.pop()
+            if stack:
+                stack[-1].add(account.cpu, account.child_cpu)  # an enclosing stage counts it too
+            totals = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0})
+            totals['wall'] += time.perf_counter() - wall
+            totals['cpu'] += time.thread_time() - cpu + account.cpu
+            totals['child_cpu'] += account.child_cpu
+
+    def progress_hook(self, d):
+        """yt-dlp progress hook recording how far the transfer has got."""
+        if d['status'] in ('downloading', 'finished'):
+            self.downloaded_bytes = d.get('downloaded_bytes') or 0
+            self.total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if self.listener:
+                self.listener(self, 'progress')
+
+    def finish(self, status, error=None):
+        self.finished = time.time()
+        self.status = status
+        self.error = error
+
+    def to_dict(self):
+        transfer = self.stages.get('transfer', {}).get('wall')
+        return {
+            'link': self.link,
+            'format': self.file_format,
+            'status': self.status,
+            'error': str(self.error) if self.error else None,
+            'started': self.started,
+            'wall': round((self.finished or time.time()) - self.started, 4),
+            'bytes': self.bytes,
+            'throughput_bytes_per_s': round(self.bytes / transfer) if transfer else None,
+            'stages': {name: {key: round(value, 4) for key, value in totals.items()} for name, totals in self.stages.items()},
+            'retries': dict(self.retries),
+        }
+
+TRANSIENT, RATE_LIMITED, PERMANENT = 'transient', 'rate-limited', 'permanent'
+RETRY_BASE_DELAY = 2
+RATE_LIMIT_BASE_DELAY = 30
+RETRY_MAX_DELAY = 300
+
+# Lower-cased fragments of yt-dlp error messages that no amount of retrying will fix
+PERMANENT_ERROR_MESSAGES = (
+    'private video', 'video unavailable', 'this video is not available', 'has been removed',
+    'account associated with this video has been terminated', 'copyright', 'members-only',
+    'sign in to confirm your age', 'unsupported url', 'is not a valid url', 'requested format is not available',
+    'http error 404', 'http error 410',
+)
+
+EXTERNAL_TOOLS = ('ffmpeg', 'ffprobe')
+
+def classify_error(error):
+    """Classify an exception as TRANSIENT, RATE_LIMITED or PERMANENT."""
+    from mutagen import MutagenError
+    from yt_dlp.utils import DownloadError, ExtractorError, UnsupportedError
+
+    if isinstance(error, ExpiredInfoError):
+        return TRANSIENT
+    if isinstance(error, (ValueError, MutagenError, UnsupportedError, subprocess.CalledProcessError)):
+        return PERMANENT  # ffmpeg fails the same way on the same input every time
+    if isinstance(error, FileNotFoundError) and error.filename in EXTERNAL_TOOLS:
+        return PERMANENT  # not installed
+    status = getattr(getattr(error, 'response', None), 'status_code', None) or getattr(getattr(error, 'response', None), 'status', None)
+    message = str(error).lower()
+    if status == 429 or 'http error 429' in message or 'too many requests' in message:
+        return RATE_LIMITED
+    if status and 400 <= status < 500 and status not in (403, 408):
+        return PERMANENT
+    if isinstance(error, ExtractorError) and error.expected:
+        return PERMANENT
+    if isinstance(error, DownloadError) and error.exc_info and error.exc_info[1] is not None and error.exc_info[1] is not error:
+        cause = classify_error(error.exc_info[1])
+        if cause != TRANSIENT:
+            return cause
+    if any(fragment in message for fragment in PERMANENT_ERROR_MESSAGES):
+        return PERMANENT
+    return TRANSIENT
+
+def retry_delay(error, kind, attempt):
+    """Exponential backoff with full jitter; rate limits back off harder and honour Retry-After."""
+    retry_after = getattr(getattr(error, 'response', None), 'headers', None)
+    retry_after = retry_after.get('Retry-After') if retry_after else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), RETRY_MAX_DELAY)
+    base = RATE_LIMIT_BASE_DELAY if kind == RATE_LIMITED else RETRY_BASE_DELAY
+    return random.uniform(0, min(RETRY_MAX_DELAY, base * 2 ** attempt))
+
+def retry_stage(stage, retries, func, *args, metrics=None, **kwargs):
+    """Call func, retrying only this stage on transient and rate-limit errors."""
+    for attempt in range(retries):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            from yt_dlp.utils import DownloadCancelled
+
+            if isinstance(e, DownloadCancelled):
+                raise  # paused or cancelled on purpose, not a failure
+            kind = classify_error(e)
+            logging.error(f"{stage.capitalize()} attempt {attempt + 1} failed ({kind}): {e}")
+            if kind == PERMANENT or attempt >= retries - 1:
+                raise
+            if metrics is not None:
+                metrics.retries[stage] = metrics.retries.get(stage, 0) + 1
+            time.sleep(retry_delay(e, kind, attempt))
+
+CACHE_DIR = os.path.join(os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'streamflare')
+INFO_CACHE_DIR = os.path.join(CACHE_DIR, 'info')
+INFO_CACHE_TTL = 3600  # seconds; stream URLs inside the info dict expire after a few hours
+INFO_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Download errors that mean the cached stream URLs have expired and the info must be re-extracted
+EXPIRED_URL_MESSAGES = ('http error 403', 'http error 404', 'http error 410')
+
+class ExpiredInfoError(Exception):
+    """Cached stream URLs stopped working; the cache entry is gone, so a retry extracts afresh."""
+
+def info_cache_path(link, proxy=None):
+    key = get_video_key(link) or link
+    if proxy:
+        # Stream URLs are often bound to the IP that extracted them, so every proxy gets its own entry
+        key = f"{key} via {proxy}"
+    return os.path.join(INFO_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.json.gz')
+
+def load_cached_info(link, proxy=None):
+    """Return the cached extract_info result for link, or None if missing or older than INFO_CACHE_TTL."""
+    path = info_cache_path(link, proxy)
+    try:
+        modified = os.path.getmtime(path)
+        if time.time() - modified > INFO_CACHE_TTL:
+            os.remove(path)
+            return None
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            info_dict = json.load(f)
+        # Record the hit in atime so eviction drops the least recently used entries first
+        os.utime(path, (time.time(), modified))
+        return info_dict
+    except (OSError, ValueError):
+        return None
+
+def store_cached_info(link, info_dict, proxy=None):
+    path = info_cache_path(link, proxy)
+    os.makedirs(INFO_CACHE_DIR, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump(info_dict, f)
+    os.replace(temp_path, path)
+    evict_cached_info()
+
+def invalidate_cached_info(link, proxy=None):
+    try:
+        os.remove(info_cache_path(link, proxy))
+    except OSError:
+        pass
+
+def evict_cached_info():
+    """Delete least recently used cache entries until the cache fits in INFO_CACHE_MAX_BYTES."""
+    entries = []
+    for entry in os.scandir(INFO_CACHE_DIR):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= INFO_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+STORE_DIR = os.path.join(CACHE_DIR, 'store')
+STORE_MAX_BYTES = 10 * 1024 ** 3
+STORE_INDEX_NAME = 'index.sqlite3'
+# Everything besides the source and the format that decides what an output looks like
+STORE_QUALITY = f'best-{AUDIO_BITRATE}'
+FICLONE = 0x40049409  # Linux ioctl that makes a file share another's extents (btrfs, xfs, ...)
+
+class MediaStore:
+    """Content-addressed store of finished outputs, shared by every output directory.
+
+    Entries are keyed by (video key, format, STORE_QUALITY) and point at an object named
+    after the sha256 of its content; outputs are made from objects with clone_file. When the
+    objects outgrow max_bytes the least recently used ones are evicted, which never touches
+    outputs already made from them. Only outputs on the store's filesystem are stored, since
+    anywhere else they would have to be copies. Plain attributes only, so it can be sent to
+    worker processes.
+    """
+
+    def __init__(self, path=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def connect(self):
+        os.makedirs(self.path, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.path, STORE_INDEX_NAME), timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "video_key TEXT NOT NULL, file_format TEXT NOT NULL, quality TEXT NOT NULL, "
+            "sha256 TEXT NOT NULL, size INTEGER NOT NULL, title TEXT NOT NULL, used_at REAL NOT NULL, "
+            "PRIMARY KEY (video_key, file_format, quality))"
+        )
+        return conn
+
+    def shares_filesystem(self, path):
+        """Whether outputs in path can be reflinks or hardlinks to objects, rather than extra copies."""
+        os.makedirs(self.path, exist_ok=True)
+        return os.stat(self.path).st_dev == os.stat(path).st_dev
+
+    def object_path(self, checksum, file_format):
+        return os.path.join(self.path, checksum[:2], f'{checksum}.{file_format}')
+
+    def lookup(self, video_key, file_format):
+        """Return (object path, checksum, title) for a stored output, or None."""
+        conn = self.connect()
+        try:
+            key = (video_key, file_format, STORE_QUALITY)
+            row = conn.execute(
+                "SELECT sha256, size, title FROM entries WHERE video_key = ? AND file_format = ? AND quality = ?", key,
+            ).fetchone()
+            if row is None:
+                return None
+            checksum, size, title = row
+            path = self.object_path(checksum, file_format)
+            with conn:
+                if os.path.exists(path) and os.path.getsize(path) == size:
+                    conn.execute("UPDATE entries SET used_at = ? WHERE video_key = ? AND file_format = ? AND quality = ?",
+                                 (time.time(),) + key)
+                    return path, checksum, title
+                # The object was deleted, or rewritten through a hardlinked output
+                conn.execute("DELETE FROM entries WHERE video_key = ? AND file_format = ? AND quality = ?", key)
+            return None
+        finally:
+            conn.close()
+
+    def put(self, video_key, file_format, title, file_path):
+        """Move file_path into the store, returning (object path, checksum)."""
+        checksum = file_checksum(file_path)
+        path = self.object_path(checksum, file_format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A rename when the store shares a filesystem with the scratch directory, else a copy
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.move(file_path, temp_path)
+        os.replace(temp_path, path)
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (video_key, file_format, STORE_QUALITY, checksum, os.path.getsize(path), title, time.time()))
+            self.evict(conn, keep=checksum)
+        finally:
+            conn.close()
+        return path, checksum
+
+    def evict(self, conn, keep=None):
+        """Delete least recently used objects until the store fits in max_bytes."""
+        objects = conn.execute(
+            "SELECT sha256, file_format, size FROM entries GROUP BY sha256, file_format ORDER BY MAX(used_at)"
+        ).fetchall()
+        total = sum(size for _, _, size in objects)
+        for checksum, file_format, size in objects:
+            if total <= self.max_bytes:
+                break
+            if checksum == keep:
+                continue
+            with conn:
+                conn.execute("DELETE FROM entries WHERE sha256 = ? AND file_format = ?", (checksum, file_format))
+            try:
+                os.remove(self.object_path(checksum, file_format))
+            except OSError:
+                pass
+            total -= size
+
+store = MediaStore()
+
+def configure_store(path=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+    """Replace the process-wide output store; a max_bytes of 0 turns it off."""
+    global store
+    store = MediaStore(path, max_bytes) if max_bytes else None
+    return store
+
+def reflink(source, target):
+    """Try to make target a copy-on-write clone of source, returning whether it worked."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(target)
+    return False
+
+def clone_file(source, target):
+    """Create target from source as a reflink, else a hardlink, else a copy, in one atomic step.
+
+    Reflinks come first because editing one of them never changes the other. Raises
+    FileExistsError instead of replacing an existing target.
+    """
+    open(target, 'xb').close()  # claim the name
+    temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if not reflink(source, temp_path):
+            try:
+                os.link(source, temp_path)
+            except OSError:
+                shutil.copyfile(source, temp_path)
+        os.replace(temp_path, target)
+    except BaseException:
+        for path in (temp_path, target):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        raise
+
+def same_content(path, other):
+    return os.path.samefile(path, other) or (os.path.getsize(path) == os.path.getsize(other) and
+                                             file_checksum(path) == file_checksum(other))
+
+def link_output(source, target):
+    """clone_file source to target, returning the path used.
+
+    When target already holds something else, the output gets a numbered name next to it
+    (title_2.mp3, ...) rather than overwriting it; a target with the same content is reused.
+    """
+    stem, ext = os.path.splitext(target)
+    for number in itertools.count(1):
+        candidate = target if number == 1 else f"{stem}_{number}{ext}"
+        try:
+            clone_file(source, candidate)
+            return candidate
+        except FileExistsError:
+            if os.path.exists(candidate) and same_content(source, candidate):
+                return candidate
+            if number == 1:
+                logging.warning(f"{target} already exists with other content, saving under a new name")
+
+def extract_info_cached(ydl, link):
+    """Return (unprocessed info dict, whether it came from the cache) for link, extracting it only on a cache miss.
+
+    Entries are kept per proxy: the stream URLs are then downloaded from where they were extracted.
+    """
+    proxy = ydl.params.get('proxy')
+    info_dict = load_cached_info(link, proxy)
+    if info_dict is not None:
+        logging.info(f"Using cached metadata for {link}")
+        return info_dict, True
+    info_dict = ydl.extract_info(link, download=False, process=False)
+    if info_dict.get('_type', 'video') == 'video':
+        store_cached_info(link, ydl.sanitize_info(info_dict), proxy)
+    return info_dict, False
+
+class TokenBucket:
+    """Bandwidth cap shared by every transfer in the process, in bytes per second.
+
+    Callers reserve time on a single timeline in the order they ask, so concurrent
+    transfers get an even share of the rate instead of racing for it. Up to `burst`
+    seconds of unused allowance may be spent at once.
+    """
+
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.available_at = time.monotonic() - burst
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Block until `amount` bytes fit under the cap."""
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now - self.burst) + amount / self.rate
+            delay = self.available_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+class Scheduler:
+    """Process-wide transfer limits: a global bytes/sec cap, per-host and per-proxy concurrency.
+
+    Every transfer holds a slot() for its site's host and for one proxy of the pool. Proxies
+    are handed out least-loaded first, rotating between equally loaded ones, and a proxy
+    that gets rate limited is rested for a while. Transfers charge their bytes to the
+    shared TokenBucket through throttle_hook().
+    """
+
+    def __init__(self, rate_limit=None, max_per_host=None, proxies=(), max_per_proxy=None):
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.max_per_host = max_per_host
+        self.max_per_proxy = max_per_proxy
+        self.proxies = []
+        self.active_hosts = {}
+        self.active_proxies = {}
+        self.resting = {}  # proxy -> time.monotonic() it may be used again
+        self.rotation = itertools.count()
+        self.condition = threading.Condition()
+        self.set_proxies(proxies)
+
+    def set_proxies(self, proxies):
+        """Replace the proxy pool; transfers already using a removed proxy keep it until they finish."""
+        with self.condition:
+            self.proxies = list(dict.fromkeys(proxy for proxy in proxies if proxy))
+            for proxy in self.proxies:
+                self.active_proxies.setdefault(proxy, 0)
+            self.condition.notify_all()
+
+    def pick_proxy(self, now):
+        candidates = [proxy for proxy in self.proxies if self.resting.get(proxy, 0) <= now and
+                      (not self.max_per_proxy or self.active_proxies[proxy] < self.max_per_proxy)]
+        if not candidates:
+            return None
+        start = next(self.rotation)
+        order = {proxy: (index - start) % len(self.proxies) for index, proxy in enumerate(self.proxies)}
+        return min(candidates, key=lambda proxy: (self.active_proxies[proxy], order[proxy]))
+
+    @contextlib.contextmanager
+    def slot(self, link):
+        """Wait for a free slot for link's host and a proxy, yielding the proxy (None without a pool)."""
+        host = urlsplit(link).hostname or ''
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                proxy = self.pick_proxy(now)
+                host_free = not self.max_per_host or self.active_hosts.get(host, 0) < self.max_per_host
+                if host_free and (proxy or not self.proxies):
+                    break
+                resting = [until for until in self.resting.values() if until > now]
+                self.condition.wait(min(resting) - now if resting else None)
+            self.active_hosts[host] = self.active_hosts.get(host, 0) + 1
+            if proxy:
+                self.active_proxies[proxy] += 1
+        try:
+            yield proxy
+        finally:
+            with self.condition:
+                self.active_hosts[host] -= 1
+                if proxy:
+                    self.active_proxies[proxy] -= 1
+                self.condition.notify_all()
+
+    def report_error(self, proxy, error):
+        """Rest a proxy that upstream is rate limiting, so the next attempts use the others."""
+        if proxy and classify_error(error) == RATE_LIMITED:
+            retry_after = getattr(getattr(error, 'response', None), 'headers', None)
+            retry_after = retry_after.get('Retry-After') if retry_after else None
+            delay = min(int(retry_after), RETRY_MAX_DELAY) if retry_after and retry_after.isdigit() else RATE_LIMIT_BASE_DELAY
+            logging.warning(f"Resting proxy {proxy} for {delay} seconds after: {error}")
+            with self.condition:
+                self.resting[proxy] = time.monotonic() + delay
+
+    def throttle_hook(self):
+        """Return a yt-dlp progress hook charging one transfer's bytes to the bucket, or None without a cap."""
+        if not self.bucket:
+            return None
+        seen = {}
+        lock = threading.Lock()
+
+        def hook(d):
+            if d['status'] != 'downloading':
+                return
+            filename, downloaded = d.get('filename'), d.get('downloaded_bytes') or 0
+            with lock:
+                # The first report of a resumed file includes what was already on disk
+                previous = seen.setdefault(filename, downloaded)
+                seen[filename] = max(previous, downloaded)
+            if downloaded > previous:
+                self.bucket.consume(downloaded - previous)
+
+        return hook
+
+scheduler = Scheduler()
+
+def configure_scheduler(rate_limit=None, max_per_host=None, proxies=(), max_per_proxy=None):
+    """Replace the process-wide scheduler that every download goes through."""
+    global scheduler
+    scheduler = Scheduler(rate_limit, max_per_host, proxies, max_per_proxy)
+    return scheduler
+
+def download_info(ydl, info_dict, job_dir, stem, connections=1):
+    """Select formats for an unprocessed info dict and download them into job_dir."""
+    if connections <= 1:
+        return ydl.process_ie_result(info_dict, download=True)
+
+    info_dict = ydl.process_ie_result(info_dict, download=False)
+    requested = info_dict.get('requested_formats') or [info_dict]
+    if not all(f.get('url') and f.get('protocol') in ('http', 'https') for f in requested):
+        ydl.process_info(info_dict)
+        return info_dict
+
+    parts = []
+    for f in requested:
+        part = os.path.join(job_dir, f"{stem}.f{f['format_id']}.{f['ext']}")
+        segmented_download(f['url'], part, connections, headers=f.get('http_headers'), proxy=ydl.params.get('proxy'),
+                           progress_hooks=ydl.params.get('progress_hooks') or ())
+        parts.append(part)
+    target = os.path.join(job_dir, f"{stem}.{info_dict['ext']}")
+    if len(parts) == 1:
+        os.replace(parts[0], target)
+    else:
+        command = ['ffmpeg', '-y', '-loglevel', 'error']
+        for part in parts:
+            command += ['-i', part]
+        for index in range(len(parts)):
+            command += ['-map', f'{index}']
+        run_tool(command + ['-c', 'copy', target])
+        for part in parts:
+            os.remove(part)
+    return info_dict
+
+def fetch_media(link, job_dir, file_format, quiet=False, connections=1, metrics=None, user_agent=None, subtitles=None):
+    """Download stage: fetch the best source stream into job_dir without postprocessing.
+
+    With connections > 1, plain HTTP(S) formats are fetched by segmented_download and
+    merged here; anything else (HLS, DASH fragments...) is left to yt-dlp. subtitles is a
+    list of languages to fetch next to the media.
+    """
+    if file_format in AUDIO_FORMATS:
+        stem = 'temp_audio'
+    elif file_format in VIDEO_FORMATS:
+        stem = 'temp_video'
+    else:
+        raise ValueError("Invalid format specified.")
+
+    ydl_opts = {
+        'format': format_selector(file_format),
+        'outtmpl': os.path.join(job_dir, f'{stem}.%(ext)s'),
+        'noplaylist': True,
+        # Resume .part files left in job_dir by an earlier attempt
+        'continuedl': True,
+    }
+    if quiet:
+        ydl_opts.update({'quiet': True, 'noprogress': True})
+    if user_agent:
+        ydl_opts['http_headers'] = {'User-Agent': user_agent}
+    if subtitles:
+        ydl_opts.update({'writesubtitles': True, 'subtitleslangs': list(subtitles)})
+
+    from yt_dlp import YoutubeDL
+
+    metrics = metrics or JobMetrics(link, file_format)
+    throttle = scheduler.throttle_hook()
+    ydl_opts['progress_hooks'] = [metrics.progress_hook] + ([throttle] if throttle else [])
+    # Every attempt takes a fresh slot, so retries rotate to another proxy of the pool
+    with scheduler.slot(link) as proxy:
+        if proxy:
+            ydl_opts['proxy'] = proxy
+        try:
+            with YoutubeDL(ydl_opts) as ydl:
+                # Extraction is kept apart from the download so retries and other formats reuse it
+                with metrics.stage('extract'):
+                    info_dict, cached = extract_info_cached(ydl, link)
+                try:
+                    with metrics.stage('transfer'):
+                        info_dict = download_info(ydl, info_dict, job_dir, stem, connections)
+                except Exception as e:
+                    if any(fragment in str(e).lower() for fragment in EXPIRED_URL_MESSAGES):
+                        invalidate_cached_info(link, proxy)
+                        if cached:
+                            # A 404 on fresh URLs is final, on cached ones it calls for a re-extract
+                            raise ExpiredInfoError(f"Cached stream URLs for {link} have expired: {e}") from e
+                    raise
+        except Exception as e:
+            scheduler.report_error(proxy, e)
+            raise
+
+    metadata = {
+        'id': info_dict.get('id'),
+        'extractor_key': info_dict.get('extractor_key', ''),
+        'title': info_dict.get('title', 'Unknown Title'),
+        'uploader': info_dict.get('uploader', 'Unknown Uploader'),
+        'thumbnail': info_dict.get('thumbnail'),
+        'subtitles': fetch_subtitles(info_dict, job_dir, stem),
+    }
+    temp_file = find_temp_file(job_dir, stem)
+    metrics.bytes = os.path.getsize(temp_file)
+    return temp_file, metadata
+
+def fetch_subtitles(info_dict, job_dir, stem):
+    """Return {language: file} for the info dict's requested subtitles, fetching any yt-dlp did not write."""
+    files = {}
+    for language, subtitle in (info_dict.get('requested_subtitles') or {}).items():
+        path = subtitle.get('filepath') or os.path.join(job_dir, f"{stem}.{language}.{subtitle['ext']}")
+        try:
+            # Segmented downloads bypass yt-dlp's own subtitle writing
+            if not os.path.exists(path):
+                data = subtitle.get('data')
+                if data is None:
+                    response = get_http_session().get(subtitle['url'], timeout=30)
+                    response.raise_for_status()
+                    data = response.content
+                with open(path, 'wb') as f:
+                    f.write(data.encode('utf-8') if isinstance(data, str) else data)
+        except Exception as e:
+            logging.error(f"Failed to fetch {language} subtitles: {e}")
+            continue
+        files[language] = path
+    return files
+
+def fetch_with_retries(link, output_dir, file_format, retries=3, quiet=False, connections=1, metrics=None, user_agent=None,
+                       subtitles=None):
+    """Run fetch_media with retries, returning (job_dir, temp_file, metadata).
+
+    Every attempt reuses the job's scratch directory so partial downloads are resumed, and
+    it is kept after the last failed attempt so the next run can pick up from there.
+    """
+    job_dir = make_job_dir(output_dir, link, file_format)
+    logging.info(f"Downloading from link: {link}")
+    try:
+        temp_file, metadata = retry_stage('download', retries, fetch_media, link, job_dir, file_format, quiet, connections,
+                                          metrics, user_agent, subtitles, metrics=metrics)
+    except Exception:
+        release_job_dir(job_dir, keep_partial=True)
+        raise
+    return job_dir, temp_file, metadata
+
+def finish_media(temp_file, output_dir, file_format, final_name, metadata, use_archive=True, retries=3, metrics=None,
+                 store=None):
+    """Transcode/tag stage: convert temp_file if needed, tag it and publish it into output_dir.
+
+    Conversion and tagging are retried on their own, so a failure there never costs a
+    re-download. With a MediaStore the result is kept there and output_dir gets a link to it.
+    Runs in a worker process during batch downloads, so it only takes picklable arguments.
+    """
+    metrics = metrics or JobMetrics(file_format=file_format)
+    job_dir = os.path.dirname(temp_file)
+    final_file = os.path.join(output_dir, final_name)
+
+    if os.path.splitext(temp_file)[1][1:] != file_format:
+        # convert_file stream-copies whatever the target container can already hold
+        staged_file = os.path.join(job_dir, f'converted.{file_format}')
+        with metrics.stage('conversion'):
+            retry_stage('conversion', retries, convert_file, temp_file, staged_file,
+                        audio_only=file_format in AUDIO_FORMATS, metrics=metrics)
+    else:
+        staged_file = temp_file
+
+    if file_format in AUDIO_FORMATS:
+        try:
+            with metrics.stage('tagging'):
+                retry_stage('tagging', retries, add_metadata_to_audio, staged_file, metadata['title'], metadata['uploader'],
+                            thumbnail_url=metadata['thumbnail'], metrics=metrics)
+        except Exception as e:
+            logging.error(f"Failed to add metadata: {e}")
+
+    # Tag in scratch, then publish atomically, never over an existing file
+    with metrics.stage('publish'):
+        video_key = f"{metadata['extractor_key'].lower()} {metadata['id']}" if metadata['id'] else None
+        checksum = None
+        # Storing across filesystems would write every file twice and keep a full copy of it
+        if store and video_key and store.shares_filesystem(output_dir):
+            staged_file, checksum = store.put(video_key, file_format, metadata['title'], staged_file)
+        final_file = link_output(staged_file, final_file)
+        for language, path in metadata.get('subtitles', {}).items():
+            os.replace(path, f"{os.path.splitext(final_file)[0]}.{language}{os.path.splitext(path)[1]}")
+        if use_archive and video_key:
+            archive_record(output_dir, video_key, file_format, final_file, checksum)
+    return final_file
+
+def finish_job(temp_file, output_dir, file_format, final_name, metadata, use_archive, retries, metrics, store):
+    """finish_media for worker processes, returning (final_file, error, metrics).
+
+    The worker fills in its own copy of metrics, so the copy is sent back with the result.
+    """
+    try:
+        return finish_media(temp_file, output_dir, file_format, final_name, metadata, use_archive, retries, metrics,
+                            store), None, metrics
+    except Exception as e:
+        return None, e, metrics
+
+def final_filename(metadata, file_format, custom_filename=None):
+    return sanitize_filename(custom_filename) if custom_filename else sanitize_filename(f"{metadata['title']}.{file_format}")
+
+def archived_file(link, output_dir, file_format, custom_filename=None):
+    """Return the archived output for link in output_dir, if it is there under the requested name."""
+    video_key = get_video_key(link)
+    if video_key:
+        archived = archive_lookup(output_dir, video_key, file_format)
+        # Another custom filename is another output; the store can still make it without a download
+        if archived and (not custom_filename or os.path.basename(archived) == sanitize_filename(custom_filename)):
+            logging.info(f"Skipping {link}, already downloaded as {archived}")
+            return archived
+    return None
+
+def stored_file(link, output_dir, file_format, custom_filename=None, use_archive=True):
+    """Link link's output into output_dir from the store, returning its path, or None if it is not stored."""
+    video_key = get_video_key(link) if store else None
+    entry = store.lookup(video_key, file_format) if video_key else None
+    if not entry:
+        return None
+    path, checksum, title = entry
+    try:
+        final_file = link_output(path, os.path.join(output_dir, final_filename({'title': title}, file_format, custom_filename)))
+    except OSError as e:
+        # Evicted in the meantime, most likely
+        logging.warning(f"Could not link {link} from the store: {e}")
+        return None
+    if use_archive:
+        archive_record(output_dir, video_key, file_format, final_file, checksum)
+    logging.info(f"Linked {link} from the store as {final_file}")
+    return final_file
+
+def download_youtube(link, output_dir, file_format, custom_filename=None, retries=3, quiet=False, use_archive=True, connections=1,
+                     metrics=None, user_agent=None, subtitles=None):
+    """Download one link; pass a JobMetrics as metrics to get its stage timings back."""
+    if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
+        raise ValueError("Invalid format specified.")
+    metrics = metrics or JobMetrics(link, file_format)
+    if use_archive:
+        archived = archived_file(link, output_dir, file_format, custom_filename)
+        if archived:
+            metrics.finish('cached')
+            return archived
+    # Subtitles are not kept in the store, so those jobs still go to the source
+    stored = None if subtitles else stored_file(link, output_dir, file_format, custom_filename, use_archive)
+    if stored:
+        metrics.finish('cached')
+        return stored
+
+    try:
+        job_dir, temp_file, metadata = fetch_with_retries(link, output_dir, file_format, retries, quiet, connections, metrics,
+                                                          user_agent, subtitles)
+    except Exception as e:
+        metrics.finish('failed', e)
+        raise
+    try:
+        final_file = finish_media(temp_file, output_dir, file_format, final_filename(metadata, file_format, custom_filename),
+                                  metadata, use_archive, retries, metrics, store)
+    except Exception as e:
+        logging.error(f"Failed to finish {link}: {e}")
+        metrics.finish('failed', e)
+        raise
+    finally:
+        release_job_dir(job_dir)
+    metrics.finish('ok')
+    return final_file
+
+class MetricsRecorder:
+    """Collect finished JobMetrics as JSON lines and Prometheus-style text totals.
+
+    Pass `record` as download_batch's on_metrics. JSON lines are appended to jsonl_path,
+    the text exposition is rewritten at prometheus_path after every job, and serve()
+    exposes it over HTTP at /metrics.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.bytes = 0
+        self.job_seconds = 0.0
+        self.stage_seconds = {}
+        self.stage_runs = {}
+        self.retries = {}
+
+    def record(self, metrics):
+        line = metrics.to_dict()
+        with self.lock:
+            self.jobs[metrics.status] = self.jobs.get(metrics.status, 0) + 1
+            self.bytes += metrics.bytes
+            self.job_seconds += line['wall']
+            for stage, totals in metrics.stages.items():
+                self.stage_runs[stage] = self.stage_runs.get(stage, 0) + 1
+                for kind, seconds in totals.items():
+                    self.stage_seconds[stage, kind] = self.stage_seconds.get((stage, kind), 0.0) + seconds
+            for stage, count in metrics.retries.items():
+                self.retries[stage] = self.retries.get(stage, 0) + count
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(line) + '\n')
+            if self.prometheus_path:
+                with open(self.prometheus_path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(self.render_locked())
+                os.replace(self.prometheus_path + '.tmp', self.prometheus_path)
+
+    def render(self):
+        with self.lock:
+            return self.render_locked()
+
+    def render_locked(self):
+        lines = ['# TYPE streamflare_jobs_total counter']
+        lines += [f'streamflare_jobs_total{{status="{status}"}} {count}' for status, count in sorted(self.jobs.items())]
+        lines += ['# TYPE streamflare_bytes_total counter', f'streamflare_bytes_total {self.bytes}']
+        lines += ['# TYPE streamflare_job_seconds_total counter', f'streamflare_job_seconds_total {self.job_seconds:.4f}']
+        lines.append('# TYPE streamflare_stage_runs_total counter')
+        lines += [f'streamflare_stage_runs_total{{stage="{stage}"}} {count}' for stage, count in sorted(self.stage_runs.items())]
+        lines.append('# TYPE streamflare_stage_seconds_total counter')
+        lines += [f'streamflare_stage_seconds_total{{stage="{stage}",kind="{kind}"}} {seconds:.4f}'
+                  for (stage, kind), seconds in sorted(self.stage_seconds.items())]
+        lines.append('# TYPE streamflare_retries_total counter')
+        lines += [f'streamflare_retries_total{{stage="{stage}"}} {count}' for stage, count in sorted(self.retries.items())]
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the text exposition at http://host:port/metrics from a daemon thread."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        recorder = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = recorder.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+def iter_links(lines):
+    """Lazily yield links from an iterable of lines (a file, stdin...), one per line or comma-separated."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        for link in line.split(','):
+            if link.strip():
+                yield link.strip()
+
+def expand_links(links, max_depth=3):
+    """Lazily yield video links, expanding playlists and channels as their entries arrive.
+
+    Links an extractor recognises as a single video are passed through without any network
+    access. Everything else goes through flat extraction, which lists entries page by page
+    instead of resolving every video up front. Nesting (channel -> tab -> playlist) is
+    followed up to max_depth levels.
+    """
+    ydl = None
+    for link in links:
+        ie, _ = match_extractor(link)
+        if ie is not None and ie._RETURN_TYPE == 'video':
+            yield link
+            continue
+        if ydl is None:
+            from yt_dlp import YoutubeDL
+
+            ydl = YoutubeDL({'extract_flat': 'in_playlist', 'lazy_playlist': True, 'quiet': True})
+        if max_depth <= 0:
+            logging.error(f"Not expanding {link}: playlists are nested too deeply")
+            continue
+        try:
+            info_dict = ydl.extract_info(link, download=False, process=False)
+            if info_dict.get('_type') in ('playlist', 'multi_video'):
+                for entry in info_dict.get('entries') or []:
+                    if entry and (entry.get('url') or entry.get('webpage_url')):
+                        # Channel pages list their tabs as nested playlists
+                        yield from expand_links([entry.get('url') or entry.get('webpage_url')], max_depth - 1)
+            elif info_dict.get('_type') in ('url', 'url_transparent') and info_dict.get('url') != link:
+                yield from expand_links([info_dict['url']], max_depth - 1)
+            else:
+                yield link
+        except Exception as e:
+            logging.error(f"Failed to expand {link}: {e}")
+
+def download_batch(links, output_dir, file_format, custom_filename=None, workers=4, transcode_workers=None, max_pending=None, retries=3, connections=1,
+                   on_metrics=None):
+    """Download links through a two-stage pipeline, yielding (link, output_file, error) as each job finishes.
+
+    on_metrics, if given, is called with each job's JobMetrics just before its result is yielded.
+
+    links may be any iterable, including a lazy generator; it is consumed only as fast as
+    jobs complete. Download threads feed fetched files into a bounded queue that a process
+    pool drains for conversion and tagging. When max_pending fetched files are waiting,
+    downloaders block, which keeps the scratch space used by the batch bounded.
+    """
+    if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
+        raise ValueError("Invalid format specified.")
+    workers = max(1, workers)
+    transcode_workers = transcode_workers or os.cpu_count() or 1
+    max_pending = max_pending or transcode_workers * 2
+    quiet = workers > 1
+
+    ready = queue.Queue(maxsize=max_pending)
+    results = queue.Queue()
+    transcode_slots = threading.Semaphore(transcode_workers)
+    # Links admitted into the pipeline but not finished yet; bounds memory for huge inputs
+    admission = threading.Semaphore(workers + max_pending + transcode_workers)
+    cancelled = threading.Event()
+    stopped = threading.Event()  # the consumer is done with the batch, so nothing more is fed
+    feed_done = object()
+    submitted = 0
+    pool_error = None  # set once the transcoder pool breaks; every job left fails with it
+
+    def download_stage(link):
+        metrics = JobMetrics(link, file_format)
+        if pool_error:
+            metrics.finish('failed', pool_error)
+            results.put((link, None, pool_error, metrics))
+            return
+        try:
+            archived = (archived_file(link, output_dir, file_format, custom_filename) or
+                        stored_file(link, output_dir, file_format, custom_filename))
+            if archived:
+                metrics.finish('cached')
+                results.put((link, archived, None, metrics))
+                return
+            job_dir, temp_file, metadata = fetch_with_retries(link, output_dir, file_format, retries, quiet, connections, metrics)
+        except Exception as e:
+            metrics.finish('failed', e)
+            results.put((link, None, e, metrics))
+            return
+        # Blocks while the transcoders are behind: this is the pipeline's backpressure
+        ready.put((link, job_dir, temp_file, metadata, metrics))
+
+    def transcode_done(future, link, job_dir, metrics):
+        try:
+            output_file, error, metrics = future.result()
+        except Exception as e:
+            output_file, error = None, e
+        metrics.finish('failed' if error else 'ok', error)
+        release_job_dir(job_dir)
+        transcode_slots.release()
+        results.put((link, output_file, error, metrics))
+
+    def transcode_stage(transcodes):
+        nonlocal pool_error
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            link, job_dir, temp_file, metadata, metrics = item
+            if cancelled.is_set() and not pool_error:
+                release_job_dir(job_dir)
+                continue
+            if not pool_error:
+                transcode_slots.acquire()
+                try:
+                    future = transcodes.submit(finish_job, temp_file, output_dir, file_format,
+                                               final_filename(metadata, file_format, custom_filename), metadata, True, retries,
+                                               metrics, store)
+                except Exception as e:
+                    # A worker died (OOM-killed in ffmpeg, say) and the pool takes no more work. This
+                    # thread keeps going, failing every job still on its way, so the batch can end.
+                    logging.error(f"Transcoder pool failed, giving up on the rest of the batch: {e}")
+                    pool_error = e
+                    cancelled.set()
+                    transcode_slots.release()
+                else:
+                    future.add_done_callback(lambda f, link=link, job_dir=job_dir, metrics=metrics: transcode_done(f, link, job_dir, metrics))
+                    continue
+            metrics.finish('failed', pool_error)
+            release_job_dir(job_dir)
+            results.put((link, None, pool_error, metrics))
+
+    def feed(downloads):
+        nonlocal submitted
+        try:
+            for link in links:
+                link = link.strip()
+                if not link:
+                    continue
+                admission.acquire()
+                if stopped.is_set():
+                    return
+                submitted += 1
+                if pool_error:
+                    # Nothing can be converted any more; the links not admitted yet fail too instead of going missing
+                    metrics = JobMetrics(link, file_format)
+                    metrics.finish('failed', pool_error)
+                    results.put((link, None, pool_error, metrics))
+                    continue
+                downloads.submit(download_stage, link)
+        except Exception as e:
+            logging.error(f"Failed to read links: {e}")
+        finally:
+            results.put(feed_done)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    # Workers start on the first submit, when the download threads are already running: forking then
+    # would copy whatever locks those threads hold (the HTTP session's, import locks) into the worker
+    with ThreadPoolExecutor(max_workers=workers) as downloads, \
+            ProcessPoolExecutor(max_workers=transcode_workers, mp_context=multiprocessing.get_context('spawn')) as transcodes:
+        dispatcher = threading.Thread(target=transcode_stage, args=(transcodes,), daemon=True)
+        dispatcher.start()
+        feeder = threading.Thread(target=feed, args=(downloads,), daemon=True)
+        feeder.start()
+
+        try:
+            with tqdm(total=0, desc="Downloading", unit='link') as bar:
+                finished, feeding = 0, True
+                while feeding or finished < submitted:
+                    item = results.get()
+                    bar.total = submitted
+                    if item is feed_done:
+                        feeding = False
+                        bar.refresh()
+                        continue
+                    finished += 1
+                    admission.release()
+                    bar.update(1)
+                    link, output_file, error, metrics = item
+                    if on_metrics:
+                        on_metrics(metrics)
+                    yield link, output_file, error
+        finally:
+            # Every link has reported, or the consumer stopped early and the remaining work is dropped
+            stopped.set()
+            cancelled.set()
+            admission.release()
+            downloads.shutdown(cancel_futures=True)
+            ready.put(None)
+            dispatcher.join()
+
+FINISHED_STATUSES = ('ok', 'cached', 'failed', 'cancelled')
+FINISHED_JOBS_KEPT = 1000  # most recent finished jobs an Engine remembers
+
+class Job:
+    """One link to download with its options, status and live progress (metrics).
+
+    status is 'queued', 'running', 'paused', 'cancelled', 'ok', 'cached' or 'failed'.
+    context is left alone for the caller to keep its own per-job data in.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, link, output_dir, file_format, custom_filename=None, user_agent=None, subtitles=None, context=None):
+        if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
+            raise ValueError("Invalid format specified.")
+        self.id = next(self._ids)
+        self.link = link
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.custom_filename = custom_filename
+        self.user_agent = user_agent
+        self.subtitles = subtitles
+        self.context = context
+        self.status = 'queued'
+        self.running = False  # a worker is on it; a paused or cancelled job may still be stopping
+        self.file = None
+        self.error = None
+        self.metrics = JobMetrics(link, file_format)
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self):
+        view = {
+            'id': self.id,
+            'link': self.link,
+            'format': self.file_format,
+            'output_dir': self.output_dir,
+            'status': self.status,
+            'file': self.file,
+            'error': str(self.error) if self.error else None,
+            'stage': self.metrics.stage_name,
+            'downloaded_bytes': self.metrics.downloaded_bytes,
+            'total_bytes': self.metrics.total_bytes,
+        }
+        if self.finished:
+            view['metrics'] = self.metrics.to_dict()
+        return view
+
+class Engine:
+    """A queue of Jobs run by a fixed pool of worker threads through download_youtube.
+
+    Jobs run in queue order, which move() changes. pause() stops a job and keeps its partial
+    download for resume(); cancel() stops it and throws the partial download away. A running
+    job stops at its next progress update.
+
+    on_event(job, event) is called from whichever thread changed the job, with event one of
+    'queued', 'started', 'stage', 'progress', 'paused', 'resumed', 'moved', 'cancelled' or
+    'finished', so it should be quick. on_metrics gets each finished job's JobMetrics.
+
+    Only the keep_finished most recent finished jobs are remembered, so a long-running
+    Engine does not keep every job it ever ran.
+    """
+
+    def __init__(self, workers=4, retries=3, connections=1, use_archive=True, on_event=None, on_metrics=None,
+                 keep_finished=FINISHED_JOBS_KEPT):
+        self.retries = retries
+        self.connections = connections
+        self.use_archive = use_archive
+        self.on_event = on_event
+        self.on_metrics = on_metrics
+        self.keep_finished = keep_finished
+        self.jobs = []  # unfinished jobs, in the order they run
+        self.finished_jobs = collections.deque()
+        self.jobs_by_id = {}
+        self.condition = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def emit(self, job, event):
+        if self.on_event:
+            self.on_event(job, event)
+
+    def submit(self, link, output_dir, file_format, custom_filename=None, **options):
+        """Queue one link, returning its Job; options are Job's user_agent, subtitles and context."""
+        job = Job(link, output_dir, file_format, custom_filename, **options)
+        job.metrics.listener = lambda metrics, event: self.metrics_changed(job, event)
+        with self.condition:
+            self.jobs.append(job)
+            self.jobs_by_id[job.id] = job
+            self.condition.notify()
+        self.emit(job, 'queued')
+        return job
+
+    def submit_iter(self, links, output_dir, file_format, custom_filename=None, **options):
+        """Queue a job for every video behind links, yielding each Job as soon as it is queued.
+
+        Playlists and channels are listed page by page, so their first videos download while
+        the rest are still being listed. custom_filename is only used when the links come
+        down to a single video. Bad arguments raise right away, not on the first next().
+        """
+        if file_format not in AUDIO_FORMATS + VIDEO_FORMATS:
+            raise ValueError("Invalid format specified.")
+        os.makedirs(output_dir, exist_ok=True)
+
+        def queue_jobs():
+            videos = expand_links(iter_links(links))
+            # The first two videos tell whether custom_filename applies
+            first = list(itertools.islice(videos, 2))
+            filename = custom_filename if len(first) == 1 else None
+            for link in itertools.chain(first, videos):
+                yield self.submit(link, output_dir, file_format, filename, **options)
+
+        return queue_jobs()
+
+    def submit_batch(self, links, output_dir, file_format, custom_filename=None, **options):
+        """submit_iter, returning every Job once the links are fully listed."""
+        return list(self.submit_iter(links, output_dir, file_format, custom_filename, **options))
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs_by_id.get(job_id)
+
+    def snapshot(self):
+        """Every job: the unfinished ones in queue order, then the finished ones."""
+        with self.condition:
+            return self.jobs + list(self.finished_jobs)
+
+    def retire(self, job):
+        """Move a job that just finished out of the queue; called with the condition held."""
+        self.jobs.remove(job)
+        self.finished_jobs.append(job)
+        while len(self.finished_jobs) > self.keep_finished:
+            del self.jobs_by_id[self.finished_jobs.popleft().id]
+
+    def pause(self, job):
+        with self.condition:
+            if job.status not in ('queued', 'running'):
+                return False
+            job.status = 'paused'
+        self.emit(job, 'paused')
+        return True
+
+    def resume(self, job):
+        with self.condition:
+            if job.status != 'paused':
+                return False
+            job.status = 'queued'
+            self.condition.notify()
+        self.emit(job, 'resumed')
+        return True
+
+    def cancel(self, job):
+        with self.condition:
+            if job.finished:
+                return False
+            job.status = 'cancelled'
+            running = job.running
+            if not running:
+                self.retire(job)
+        if not running:
+            # A running job is cleaned up by its worker once it stops
+            job.metrics.finish('cancelled')
+            discard_partial(job.output_dir, job.link, job.file_format)
+            if self.on_metrics:
+                self.on_metrics(job.metrics)
+        self.emit(job, 'cancelled')
+        return True
+
+    def move(self, job, offset):
+        """Move a job up (negative offset) or down the queue."""
+        with self.condition:
+            if job not in self.jobs:
+                return  # finished in the meantime
+            index = self.jobs.index(job)
+            self.jobs.insert(max(0, min(len(self.jobs) - 1, index + offset)), self.jobs.pop(index))
+        self.emit(job, 'moved')
+
+    def clear_finished(self):
+        with self.condition:
+            for job in self.finished_jobs:
+                del self.jobs_by_id[job.id]
+            self.finished_jobs.clear()
+
+    def metrics_changed(self, job, event):
+        # Progress updates come from the job's own transfer, so that is where it is stopped
+        if event == 'progress' and job.status in ('paused', 'cancelled'):
+            from yt_dlp.utils import DownloadCancelled
+
+            raise DownloadCancelled(f"Download {job.status}")
+        self.emit(job, event)
+
+    def next_job(self):
+        with self.condition:
+            while True:
+                job = next((job for job in self.jobs if job.status == 'queued' and not job.running), None)
+                if job:
+                    job.status = 'running'
+                    job.running = True
+                    return job
+                self.condition.wait()
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            self.emit(job, 'started')
+            error = None
+            try:
+                job.file = download_youtube(job.link, job.output_dir, job.file_format, job.custom_filename, self.retries,
+                                            quiet=True, use_archive=self.use_archive, connections=self.connections,
+                                            metrics=job.metrics, user_agent=job.user_agent, subtitles=job.subtitles)
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                job.running = False
+                if error is None:
+                    job.status = job.metrics.status  # it finished after all, even if stopped meanwhile
+                elif job.status == 'running':
+                    job.status = 'failed'
+                    job.error = error
+                # Otherwise it was paused or cancelled, or resumed before the pause took effect
+                if job.finished:
+                    self.retire(job)
+                self.condition.notify_all()
+
+            if job.status == 'cancelled':
+                job.metrics.finish('cancelled')
+                discard_partial(job.output_dir, job.link, job.file_format)
+            if job.finished:
+                if self.on_metrics:
+                    self.on_metrics(job.metrics)
+                self.emit(job, 'finished')
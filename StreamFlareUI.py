@@ -1,105 +1,87 @@
+# Downloads run on the StreamFlareCore Engine, which imports yt_dlp on first use, so the window opens without waiting for it
 import os
 import logging
-import requests
+import subprocess
 import tkinter as tk
-from tkinter import filedialog, messagebox
-from yt_dlp import YoutubeDL
-from mutagen.id3 import ID3, APIC
-from mutagen.easyid3 import EasyID3
-from pyfiglet import figlet_format
+from tkinter import filedialog, messagebox, ttk
 import customtkinter as ctk
+from StreamFlareCore import AUDIO_FORMATS, BANNER, VIDEO_FORMATS, Engine, configure_scheduler
 import threading
+import queue
+import collections
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def sanitize_filename(filename):
-    """Sanitize the filename by replacing invalid characters."""
-    return "".join(c if c.isalnum() or c in "._-" else "_" for c in filename)
-
-def convert_file(input_file, output_file):
-    """Convert the audio/video file using ffmpeg."""
-    logging.info(f"Converting {input_file} to {output_file}")
-    os.system(f"ffmpeg -i \"{input_file}\" \"{output_file}\"")
-    os.remove(input_file)
-
-def get_file_size(file_path):
-    """Return the size of a file in megabytes."""
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File {file_path} does not exist.")
-    return os.path.getsize(file_path) / (1024 * 1024)  # Convert bytes to megabytes
-
-def add_metadata_to_audio(file_path, title, artist, album=None, genre=None, year=None, thumbnail_url=None):
-    """Add metadata to the audio file."""
-    audio = EasyID3(file_path)
-    audio['title'] = title
-    audio['artist'] = artist
-    if album:
-        audio['album'] = album
-    if genre:
-        audio['genre'] = genre
-    if year:
-        audio['date'] = year
-    audio.save()
-
-    if thumbnail_url:
-        thumbnail_data = requests.get(thumbnail_url).content
-        audio = ID3(file_path)
-        audio['APIC'] = APIC(
-            encoding=3,
-            mime='image/jpeg',
-            type=3,
-            desc='Cover',
-            data=thumbnail_data
-        )
-        audio.save()
-
-def download_youtube(link, output_dir, file_format, custom_filename=None, user_agent=None, proxy=None, download_subtitles=False, log_callback=None):
-    """Download a YouTube link with retries and additional options."""
-    ydl_opts = {
-        'format': 'bestaudio/best' if file_format in ['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus'] else 'bestvideo+bestaudio/best',
-        'outtmpl': os.path.join(output_dir, 'temp.%(ext)s'),
-        'noplaylist': True,
-        'quiet': True,
-        'progress_hooks': [lambda d: log_callback(d)],
-        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': file_format, 'preferredquality': '192'}] if file_format in ['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus'] else [],
-        'proxy': proxy,
-        'headers': {'User-Agent': user_agent} if user_agent else {},
-        'subtitleslangs': ['en'] if download_subtitles else []
-    }
-    
-    temp_ext = 'webm' if file_format in ['mp4', 'mkv', 'avi', 'mov', 'flv', 'wmv', '3gp'] else file_format
-    
-    try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(link, download=True)
-            video_title = info_dict.get('title', 'Unknown Title')
-            video_uploader = info_dict.get('uploader', 'Unknown Uploader')
-            thumbnail_url = info_dict.get('thumbnail')
-
-            temp_file = os.path.join(output_dir, f'temp.{temp_ext}')
-            final_filename = sanitize_filename(custom_filename) if custom_filename else sanitize_filename(f"{video_title}.{file_format}")
-            final_file = os.path.join(output_dir, final_filename)
-
-            if not os.path.exists(temp_file):
-                raise FileNotFoundError(f"Temporary file {temp_file} does not exist.")
-
-            os.rename(temp_file, final_file)
-            
-            if file_format in ['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus']:
-                add_metadata_to_audio(final_file, video_title, video_uploader, thumbnail_url=thumbnail_url)
-
-            return final_file
-
-    except FileNotFoundError as fnf_error:
-        logging.error(f"Failed to find temporary file: {fnf_error}")
-        raise
-    except Exception as e:
-        logging.error(f"Error occurred: {e}")
-        raise
+MAX_LOG_LINES = 2000       # the log keeps only this many most recent lines
+LOG_FLUSH_INTERVAL_MS = 100
+MAX_EVENTS_PER_FLUSH = 1000
+MAX_PARALLEL_DOWNLOADS = min(4, os.cpu_count() or 1)
+MAX_DOWNLOADS_PER_HOST = 2   # more parallel downloads from one site mostly buys HTTP 429s
+MAX_DOWNLOADS_PER_PROXY = 2
+# Engine events after which a job's row may belong somewhere else in the queue panel
+REORDER_EVENTS = ('queued', 'moved', 'cancelled', 'finished')
+
+# Engine threads never touch Tk: they post ('log', text) and ('job', (Job, event)) events here
+# and the Tk main loop drains them in batches from flush_ui_events.
+ui_events = queue.Queue()
+log_history = collections.deque(maxlen=MAX_LOG_LINES)
+log_window = None
+log_text = None
+queue_window = None
+queue_tree = None
+
+def post_log(message):
+    """Queue a line for the log window; safe to call from any thread."""
+    ui_events.put(('log', message))
+
+def post_job(job, event):
+    """Queue a refresh of a job's row in the queue panel; safe to call from any thread."""
+    ui_events.put(('job', (job, event)))
+
+class QueueLogHandler(logging.Handler):
+    """Forward log records to the UI event queue; installed once on the root logger."""
+
+    def emit(self, record):
+        try:
+            post_log(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+def job_progress(job):
+    """Describe how far along a job is, for the queue panel."""
+    if job.status == 'failed':
+        return str(job.error)
+    if job.status != 'running':
+        return ''
+    metrics = job.metrics
+    if metrics.stage_name != 'transfer':
+        return f"{(metrics.stage_name or 'starting').capitalize()}..."
+    if metrics.total_bytes:
+        return f"{100 * metrics.downloaded_bytes / metrics.total_bytes:.1f}% of {metrics.total_bytes / (1024 * 1024):.1f} MB"
+    return f"{metrics.downloaded_bytes / (1024 * 1024):.1f} MB"
+
+def on_engine_event(job, event):
+    """Engine callback, run on engine threads: hand the change to the Tk loop."""
+    if event == 'finished' and job.status != 'cancelled':
+        if job.status == 'failed':
+            post_log(f"Error occurred: {job.error}")
+        else:
+            post_log(f"Downloaded and saved as {job.file}")
+            if job.context.get('open_after_download'):
+                subprocess.run(['start', '', job.file], shell=True)
+    elif event in ('paused', 'cancelled'):
+        post_log(f"Download {event}: {job.link}")
+    post_job(job, event)
 
 def show_log_window():
-    """Create and show a new window for logs and progress."""
+    """Show the log and progress window, creating it on first use."""
+    global log_window, log_text
+    if log_window is not None and log_window.winfo_exists():
+        log_window.deiconify()
+        log_window.lift()
+        return log_text
+
     log_window = ctk.CTkToplevel(root)
     log_window.title("Log and Progress")
 
@@ -126,8 +108,7 @@ def show_log_window():
     log_window.geometry(f"{log_window_width}x{log_window_height}+{log_window_x}+{log_window_y}")
 
     # Display ASCII art and welcome message
-    ascii_art = generate_ascii_art()
-    ascii_label = ctk.CTkLabel(log_window, text=ascii_art, font=("Courier", 12), justify=tk.LEFT, anchor="w")
+    ascii_label = ctk.CTkLabel(log_window, text=BANNER, font=("Courier", 12), justify=tk.LEFT, anchor="w")
     ascii_label.pack(pady=10)
 
     welcome_text = ("Welcome to the log of StreamFlare, here is everything that happens in the background when you\n download a YouTube video/audio/whatever format you want.\n")
@@ -143,56 +124,142 @@ def show_log_window():
     scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
     log_text.config(yscrollcommand=scrollbar.set)
 
-    # Redirect logging output to the text widget
-    class LogHandler(logging.Handler):
-        def __init__(self, text_widget):
-            super().__init__()
-            self.text_widget = text_widget
-
-        def emit(self, record):
-            log_entry = self.format(record)
-            self.text_widget.insert(tk.END, log_entry + '\n')
-            self.text_widget.see(tk.END)
-
-    log_handler = LogHandler(log_text)
-    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    logging.getLogger().addHandler(log_handler)
-
     # Show progress updates
     log_text.insert(tk.END, "Log window initialized.\n")
     log_text.insert(tk.END, "You can see download progress and logs here.\n")
-    log_text.insert(tk.END, "If you get an error please report it to me on Discord (user: cgcristi) or on GitHub Issues at https://github.com/CristiGitHubber/StreamFlareUI/issues")
+    log_text.insert(tk.END, "If you get an error please report it to me on Discord (user: cgcristi) or on GitHub Issues at https://github.com/CristiGitHubber/StreamFlareUI/issues\n")
+    # Replay what was logged before the window was opened
+    if log_history:
+        log_text.insert(tk.END, '\n'.join(log_history) + '\n')
+        log_text.see(tk.END)
 
     return log_text
 
-def generate_ascii_art():
-    """Generate ASCII art for StreamFlare."""
-    return figlet_format("StreamFlare", font='small')
-
-def download_thread(link, file_format, output_dir, custom_filename, user_agent, proxy, open_after_download, download_subtitles, log_text):
-    """Run the download process in a separate thread."""
-    try:
-        def log_callback(d):
-            """Update log text widget based on progress data."""
-            if d['status'] == 'downloading':
-                log_text.insert(tk.END, f"Downloading: {d['_percent_str']} {d['_eta_str']}\n")
-                log_text.see(tk.END)
-            elif d['status'] == 'finished':
-                log_text.insert(tk.END, "Download finished.\n")
-                log_text.see(tk.END)
-        
-        final_file = download_youtube(
-            link, output_dir, file_format, custom_filename, user_agent, proxy, download_subtitles, log_callback
-        )
-        log_text.insert(tk.END, f"Downloaded and saved as {final_file}\n")
-        log_text.see(tk.END)
+def show_queue_window():
+    """Show the download queue panel, creating it on first use."""
+    global queue_window, queue_tree
+    if queue_window is not None and queue_window.winfo_exists():
+        queue_window.deiconify()
+        queue_window.lift()
+        return
 
-        if open_after_download:
-            os.system(f'start {final_file}')
-    
-    except Exception as e:
-        log_text.insert(tk.END, f"Error occurred: {e}\n")
-        log_text.see(tk.END)
+    queue_window = ctk.CTkToplevel(root)
+    queue_window.title("Download Queue")
+    queue_window.geometry(f"700x350+{root.winfo_x()}+{root.winfo_y() + root.winfo_height() + 40}")
+
+    queue_tree = ttk.Treeview(queue_window, columns=('link', 'format', 'status', 'progress'), show='headings')
+    for column, heading, width in (('link', "Link", 300), ('format', "Format", 60), ('status', "Status", 90), ('progress', "Progress", 220)):
+        queue_tree.heading(column, text=heading)
+        queue_tree.column(column, width=width, anchor=tk.W)
+    queue_tree.pack(padx=10, pady=(10, 0), fill=tk.BOTH, expand=True)
+
+    buttons = ctk.CTkFrame(queue_window)
+    buttons.pack(padx=10, pady=10, fill=tk.X)
+    actions = [
+        ("Pause", engine.pause, False),
+        ("Resume", engine.resume, False),
+        ("Cancel", engine.cancel, False),
+        ("Move Up", lambda job: engine.move(job, -1), False),
+        ("Move Down", lambda job: engine.move(job, 1), True),
+    ]
+    for column, (text, action, reverse) in enumerate(actions):
+        ctk.CTkButton(buttons, text=text, width=90, command=lambda action=action, reverse=reverse: apply_to_selected_jobs(action, reverse)).grid(row=0, column=column, padx=5, pady=5)
+    ctk.CTkButton(buttons, text="Clear Finished", width=110, command=clear_finished_jobs).grid(row=0, column=len(actions), padx=5, pady=5)
+
+    refresh_queue_panel()
+
+def apply_to_selected_jobs(action, reverse=False):
+    """Run a queue action on every job selected in the queue panel."""
+    job_ids = [int(iid) for iid in queue_tree.selection()]
+    for job_id in reversed(job_ids) if reverse else job_ids:
+        job = engine.get(job_id)
+        if job:
+            action(job)
+    refresh_queue_panel()
+
+def clear_finished_jobs():
+    engine.clear_finished()
+    refresh_queue_panel()
+
+def job_row(job):
+    return (job.link, job.file_format, job.status.capitalize(), job_progress(job))
+
+def refresh_queue_panel():
+    """Bring the queue panel's rows in line with the queue's jobs and their order."""
+    if queue_tree is None or not queue_tree.winfo_exists():
+        return
+    jobs = engine.snapshot()
+    job_ids = {str(job.id) for job in jobs}
+    for iid in queue_tree.get_children():
+        if iid not in job_ids:
+            queue_tree.delete(iid)
+    for index, job in enumerate(jobs):
+        iid = str(job.id)
+        if queue_tree.exists(iid):
+            queue_tree.item(iid, values=job_row(job))
+            queue_tree.move(iid, '', index)
+        else:
+            queue_tree.insert('', index, iid=iid, values=job_row(job))
+
+def update_queue_panel(changed_jobs, reordered_ids):
+    """Refresh just the rows of changed_jobs, re-placing only those in reordered_ids.
+
+    A big playlist puts thousands of rows in the panel, so a progress tick must not touch them all.
+    """
+    if queue_tree is None or not queue_tree.winfo_exists():
+        return
+    if reordered_ids:
+        jobs = engine.snapshot()
+        index_of = {str(job.id): index for index, job in enumerate(jobs)}
+        for iid in queue_tree.get_children():
+            if iid not in index_of:
+                queue_tree.delete(iid)  # no longer among the jobs the engine remembers
+        # The other rows keep their relative order, so with the re-placed rows taken out, putting
+        # them back in ascending order lands each one at its index without moving the rest
+        for iid in reordered_ids:
+            if queue_tree.exists(iid):
+                queue_tree.detach(iid)
+        for iid in sorted((iid for iid in reordered_ids if iid in index_of), key=index_of.get):
+            if queue_tree.exists(iid):
+                queue_tree.move(iid, '', index_of[iid])
+            else:
+                queue_tree.insert('', index_of[iid], iid=iid, values=job_row(changed_jobs[iid]))
+    for iid, job in changed_jobs.items():
+        if queue_tree.exists(iid):
+            queue_tree.item(iid, values=job_row(job))
+
+def flush_ui_events():
+    """Drain queued log and job events in one batch, then reschedule itself."""
+    lines = []
+    changed_jobs = {}  # however many updates a job got, its row is refreshed once
+    reordered_ids = set()
+    for _ in range(MAX_EVENTS_PER_FLUSH):
+        try:
+            kind, payload = ui_events.get_nowait()
+        except queue.Empty:
+            break
+        if kind == 'job':
+            job, event = payload
+            changed_jobs[str(job.id)] = job
+            if event in REORDER_EVENTS:
+                reordered_ids.add(str(job.id))
+        else:
+            lines.append(payload)
+
+    if changed_jobs:
+        update_queue_panel(changed_jobs, reordered_ids)
+
+    if lines:
+        log_history.extend(lines)
+        if log_text is not None and log_text.winfo_exists():
+            log_text.insert(tk.END, '\n'.join(lines) + '\n')
+            # Trim the widget to the same ring-buffer size as log_history
+            excess = int(log_text.index('end-1c').split('.')[0]) - MAX_LOG_LINES
+            if excess > 0:
+                log_text.delete('1.0', f'{excess + 1}.0')
+            log_text.see(tk.END)
+
+    root.after(LOG_FLUSH_INTERVAL_MS, flush_ui_events)
 
 def start_download(link_entry, format_var, output_dir_entry, filename_entry, user_agent_entry, proxy_entry, open_after_download_var, download_subtitles_var):
     """Start the download process based on user inputs."""
@@ -201,7 +268,7 @@ def start_download(link_entry, format_var, output_dir_entry, filename_entry, use
     output_dir = output_dir_entry.get()
     custom_filename = filename_entry.get() or None
     user_agent = user_agent_entry.get()
-    proxy = proxy_entry.get()
+    proxies = [proxy.strip() for proxy in proxy_entry.get().split(',')]
     open_after_download = open_after_download_var.get()
     download_subtitles = download_subtitles_var.get()
 
@@ -209,8 +276,25 @@ def start_download(link_entry, format_var, output_dir_entry, filename_entry, use
         messagebox.showerror("Error", "Please fill in all required fields.")
         return
 
-    log_text = show_log_window()
-    threading.Thread(target=download_thread, args=(link, file_format, output_dir, custom_filename, user_agent, proxy, open_after_download, download_subtitles, log_text), daemon=True).start()
+    # The proxy field is the pool every queued download rotates through
+    download_scheduler.set_proxies(proxies)
+    link_entry.delete(0, tk.END)
+    show_queue_window()
+    # Playlist and channel links are listed over the network, so they are queued off the Tk thread
+    threading.Thread(target=queue_download, daemon=True, args=(
+        link, output_dir, file_format, custom_filename, user_agent or None, open_after_download, download_subtitles
+    )).start()
+
+def queue_download(link, output_dir, file_format, custom_filename, user_agent, open_after_download, download_subtitles):
+    """Queue a job for every video behind link; runs on its own thread."""
+    try:
+        jobs = engine.submit_batch([link], output_dir, file_format, custom_filename, user_agent=user_agent,
+                                   subtitles=['en'] if download_subtitles else None,
+                                   context={'open_after_download': open_after_download})
+    except Exception as e:
+        post_log(f"Error occurred: {e}")
+        return
+    post_log(f"Queued {len(jobs)} download(s) from {link} as {file_format}")
 
 root = ctk.CTk()
 
@@ -221,14 +305,13 @@ frame = ctk.CTkFrame(root)
 frame.pack(padx=20, pady=20, fill=tk.BOTH, expand=True)
 
 # ASCII Art in the main window
-ascii_art = generate_ascii_art()
-ascii_label = ctk.CTkLabel(frame, text=ascii_art, font=("Courier", 12), justify=tk.LEFT, anchor="w")
+ascii_label = ctk.CTkLabel(frame, text=BANNER, font=("Courier", 12), justify=tk.LEFT, anchor="w")
 ascii_label.grid(row=0, columnspan=2, padx=10, pady=10)
 
 # Format Selection
 ctk.CTkLabel(frame, text="Select Format:").grid(row=1, column=0, padx=10, pady=5, sticky=tk.W)
 format_var = tk.StringVar(value='mp4')
-format_menu = ctk.CTkOptionMenu(frame, variable=format_var, values=['mp3', 'flac', 'm4a', 'wav', 'aac', 'ogg', 'opus', 'mp4', 'mkv', 'avi', 'webm', 'mov', 'flv', 'wmv', '3gp'])
+format_menu = ctk.CTkOptionMenu(frame, variable=format_var, values=AUDIO_FORMATS + VIDEO_FORMATS)
 format_menu.grid(row=1, column=1, padx=10, pady=5, sticky="ew")
 
 # YouTube Link
@@ -251,9 +334,9 @@ ctk.CTkLabel(frame, text="User-Agent (Optional):").grid(row=5, column=0, padx=10
 user_agent_entry = ctk.CTkEntry(frame, placeholder_text="e.g., Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
 user_agent_entry.grid(row=5, column=1, padx=10, pady=5, sticky="ew")
 
-# Proxy URL
-ctk.CTkLabel(frame, text="Proxy URL (Optional):").grid(row=6, column=0, padx=10, pady=5, sticky=tk.W)
-proxy_entry = ctk.CTkEntry(frame, placeholder_text="e.g., http://127.0.0.1:8080")
+# Proxy URLs
+ctk.CTkLabel(frame, text="Proxy URLs (Optional):").grid(row=6, column=0, padx=10, pady=5, sticky=tk.W)
+proxy_entry = ctk.CTkEntry(frame, placeholder_text="e.g., http://127.0.0.1:8080, http://127.0.0.1:8081")
 proxy_entry.grid(row=6, column=1, padx=10, pady=5, sticky="ew")
 
 # Open After Download
@@ -276,6 +359,10 @@ download_button.grid(row=9, column=0, padx=10, pady=20, sticky="ew")
 log_button = ctk.CTkButton(frame, text="Show Log", command=show_log_window)
 log_button.grid(row=9, column=1, padx=10, pady=20, sticky="ew")
 
+# Download Queue Button
+queue_button = ctk.CTkButton(frame, text="Show Queue", command=show_queue_window)
+queue_button.grid(row=10, column=0, columnspan=2, padx=10, pady=(0, 20), sticky="ew")
+
 # Adjust UI elements to fit the window size
 frame.columnconfigure(1, weight=1)
 frame.rowconfigure(1, weight=1)
@@ -287,5 +374,14 @@ frame.rowconfigure(6, weight=1)
 frame.rowconfigure(7, weight=1)
 frame.rowconfigure(8, weight=1)
 frame.rowconfigure(9, weight=1)
+frame.rowconfigure(10, weight=1)
+
+queue_log_handler = QueueLogHandler()
+queue_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.getLogger().addHandler(queue_log_handler)
+root.after(LOG_FLUSH_INTERVAL_MS, flush_ui_events)
+
+download_scheduler = configure_scheduler(max_per_host=MAX_DOWNLOADS_PER_HOST, max_per_proxy=MAX_DOWNLOADS_PER_PROXY)
+engine = Engine(MAX_PARALLEL_DOWNLOADS, on_event=on_engine_event)
 
 root.mainloop()
@@ -0,0 +1,317 @@
+"""Offline throughput benchmark for StreamFlare.
+
+Generates test media with ffmpeg, serves it from a local HTTP server and swaps in a stub
+yt-dlp extractor that points at that server, so download_youtube and download_batch run their
+real download, conversion and tagging paths without touching the network.
+
+Every (format, mode) case runs in a fresh process so peak memory is measured per case.
+
+--startup instead times how long StreamFlare.py takes to start, which matters when scripts
+invoke it thousands of times; --max-startup-ms turns it into a pass/fail check.
+
+    python benchmark.py                          # every format, single and batch mode
+    python benchmark.py -f mp3,mp4 -n 16 -w 8    # a subset, bigger batches
+    python benchmark.py --duration 120 --video-size 1920x1080 --json results.json
+    python benchmark.py --startup --max-startup-ms 150
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import statistics
+import yt_dlp
+from yt_dlp import YoutubeDL
+from yt_dlp.extractor.common import InfoExtractor
+
+import StreamFlareCore
+
+# Source formats offered by the stub extractor: format_id -> (ext, vcodec, acodec, ffmpeg output args)
+SOURCES = {
+    'a-aac': ('m4a', 'none', 'mp4a.40.2', ['-vn', '-c:a', 'aac', '-b:a', '128k']),
+    'a-opus': ('webm', 'none', 'opus', ['-vn', '-c:a', 'libopus', '-b:a', '128k']),
+    'v-h264': ('mp4', 'avc1.64001F', 'none', ['-an', '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '{video_bitrate}']),
+    'v-vp9': ('webm', 'vp9', 'none', ['-an', '-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-b:v', '{video_bitrate}']),
+}
+
+def generate_media(media_dir, sources, duration, video_size, video_bitrate):
+    """Render each source format (and a cover image) with ffmpeg, returning the manifest."""
+    manifest = {}
+    for format_id in sources:
+        ext, vcodec, acodec, args = SOURCES[format_id]
+        path = os.path.join(media_dir, f'{format_id}.{ext}')
+        if vcodec == 'none':
+            inputs = ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}']
+        else:
+            inputs = ['-f', 'lavfi', '-i', f'testsrc2=size={video_size}:rate=30:duration={duration}']
+        args = [arg.format(video_bitrate=video_bitrate) for arg in args]
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error'] + inputs + args + [path], check=True)
+        manifest[format_id] = {'file': os.path.basename(path), 'ext': ext, 'vcodec': vcodec, 'acodec': acodec,
+                               'filesize': os.path.getsize(path)}
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=320x180',
+                    '-frames:v', '1', os.path.join(media_dir, 'thumb.jpg')], check=True)
+    with open(os.path.join(media_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler that also answers single-range requests, like a real CDN."""
+
+    def send_head(self):
+        range_header = self.headers.get('Range')
+        match = re.match(r'bytes=(\d+)-(\d*)$', range_header or '')
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            self.range = None
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(self.range))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.range is None:
+            return super().copyfile(source, outputfile)
+        remaining = self.range
+        while remaining:
+            chunk = source.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_media(media_dir):
+    handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=media_dir, **kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class LocalMediaIE(InfoExtractor):
+    """Stub extractor for http://127.0.0.1:<port>/watch/<id> links served by serve_media."""
+    IE_NAME = 'streamflare:benchmark'
+    _VALID_URL = r'http://127\.0\.0\.1:(?P<port>\d+)/watch/(?P<id>[\w-]+)'
+    manifest = {}
+
+    def _real_extract(self, url):
+        port, video_id = self._match_valid_url(url).group('port', 'id')
+        base = f'http://127.0.0.1:{port}/'
+        formats = [{
+            'format_id': format_id,
+            'url': base + source['file'],
+            'ext': source['ext'],
+            'vcodec': source['vcodec'],
+            'acodec': source['acodec'],
+            'filesize': source['filesize'],
+            'protocol': 'http',
+        } for format_id, source in self.manifest.items()]
+        return {
+            'id': video_id,
+            'title': f'StreamFlare benchmark {video_id}',
+            'uploader': 'StreamFlare',
+            'thumbnail': base + 'thumb.jpg',
+            'formats': formats,
+        }
+
+class BenchmarkYoutubeDL(YoutubeDL):
+    """YoutubeDL that only knows the stub extractor."""
+
+    def __init__(self, params=None, auto_init=True):
+        super().__init__(params, auto_init=False)
+        self.add_info_extractor(LocalMediaIE())
+
+def run_case(file_format, mode, links, workers, connections):
+    """Run one benchmark case in this process and return its measurements."""
+    import resource  # Unix-only; imported here so test_segmented_download can use serve_media anywhere
+
+    output_dir = tempfile.mkdtemp(prefix='streamflare-bench-')
+    recorder = StreamFlareCore.MetricsRecorder()
+    started, cpu_started = time.perf_counter(), os.times()
+    try:
+        if mode == 'single':
+            for link in links:
+                metrics = StreamFlareCore.JobMetrics(link, file_format)
+                try:
+                    StreamFlareCore.download_youtube(link, output_dir, file_format, quiet=True, connections=connections, metrics=metrics)
+                except Exception:
+                    pass
+                recorder.record(metrics)
+        else:
+            for _ in StreamFlareCore.download_batch(links, output_dir, file_format, workers=workers, connections=connections,
+                                                on_metrics=recorder.record):
+                pass
+        wall = time.perf_counter() - started
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    cpu_finished = os.times()
+    cpu = sum(cpu_finished[i] - cpu_started[i] for i in range(4))  # user, system, children user, children system
+    # ru_maxrss is in KiB on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    ok = recorder.jobs.get('ok', 0)
+    return {
+        'format': file_format,
+        'mode': mode,
+        'links': len(links),
+        'ok': ok,
+        'failed': len(links) - ok,
+        'wall_s': round(wall, 3),
+        'links_per_min': round(ok / wall * 60, 2),
+        'mb_per_s': round(recorder.bytes / (1024 * 1024) / wall, 2),
+        'cpu_s_per_job': round(cpu / len(links), 3),
+        'peak_rss_mb': round(peak_rss / 1024, 1),
+        'stage_wall_s': {stage: round(seconds, 3) for (stage, kind), seconds in recorder.stage_seconds.items() if kind == 'wall'},
+    }
+
+def case_main(args):
+    """Entry point of the per-case child process."""
+    logging.getLogger().setLevel(logging.WARNING)
+    with open(os.path.join(args.media_dir, 'manifest.json')) as f:
+        LocalMediaIE.manifest = json.load(f)
+    # StreamFlareCore imports YoutubeDL from yt_dlp when it needs it
+    yt_dlp.YoutubeDL = BenchmarkYoutubeDL
+    # Cold metadata cache and store for every case, so extraction and downloads are measured too
+    StreamFlareCore.INFO_CACHE_DIR = tempfile.mkdtemp(prefix='streamflare-bench-cache-')
+    store = StreamFlareCore.configure_store(tempfile.mkdtemp(prefix='streamflare-bench-store-'))
+    links = [f'http://127.0.0.1:{args.port}/watch/bench-{args.case_mode}-{i}' for i in range(args.links)]
+    try:
+        result = run_case(args.case_format, args.case_mode, links, args.workers, args.connections)
+    finally:
+        shutil.rmtree(StreamFlareCore.INFO_CACHE_DIR, ignore_errors=True)
+        shutil.rmtree(store.path, ignore_errors=True)
+    print(json.dumps(result))
+
+STREAMFLARE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'StreamFlare.py')
+
+# Startup case -> (command line, stdin)
+STARTUP_CASES = {
+    'import': ([sys.executable, '-c', 'import StreamFlare'], ''),
+    'help': ([sys.executable, STREAMFLARE, '--help'], ''),
+    # Answers the first prompt with an invalid format, so this is the time to the first prompt
+    'prompt': ([sys.executable, STREAMFLARE, '--no-banner'], 'none\n'),
+    'batch': ([sys.executable, STREAMFLARE, '-f', 'mp3', '-i', '-', '-o', '{output_dir}'], ''),
+}
+
+def run_startup(runs):
+    """Time each startup case `runs` times in fresh interpreters, returning min/median wall time."""
+    output_dir = tempfile.mkdtemp(prefix='streamflare-bench-')
+    cwd = os.path.dirname(STREAMFLARE)
+    results = []
+    try:
+        for case, (command, stdin) in STARTUP_CASES.items():
+            command = [arg.format(output_dir=output_dir) for arg in command]
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                subprocess.run(command, input=stdin, capture_output=True, text=True, cwd=cwd, check=True)
+                timings.append((time.perf_counter() - started) * 1000)
+            results.append({'case': case, 'runs': runs, 'min_ms': round(min(timings), 1),
+                            'median_ms': round(statistics.median(timings), 1)})
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+def print_table(results, columns=('format', 'mode', 'ok', 'links_per_min', 'mb_per_s', 'cpu_s_per_job', 'peak_rss_mb')):
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        row = [f"{result['ok']}/{result['links']}" if column == 'ok' else str(result[column]) for column in columns]
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline StreamFlare throughput benchmark (needs ffmpeg/ffprobe, no network).")
+    parser.add_argument('-f', '--formats', default=','.join(StreamFlareCore.AUDIO_FORMATS + StreamFlareCore.VIDEO_FORMATS),
+                        help="comma-separated output formats to benchmark (default: all)")
+    parser.add_argument('-m', '--modes', default='single,batch', help="'single' (download_youtube loop) and/or 'batch' (download_batch)")
+    parser.add_argument('-n', '--links', type=int, default=4, help="links per case (default: 4)")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="batch download workers (default: 4)")
+    parser.add_argument('-c', '--connections', type=int, default=1, help="connections per download (default: 1)")
+    parser.add_argument('--sources', default=','.join(SOURCES), help=f"source formats to offer (default: {','.join(SOURCES)})")
+    parser.add_argument('--duration', type=int, default=10, help="length of the generated media in seconds (default: 10)")
+    parser.add_argument('--video-size', default='640x360', help="generated video size (default: 640x360)")
+    parser.add_argument('--video-bitrate', default='1M', help="generated video bitrate (default: 1M)")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--startup', action='store_true', help="time StreamFlare.py startup instead of downloads")
+    parser.add_argument('--startup-runs', type=int, default=10, help="runs per startup case (default: 10)")
+    parser.add_argument('--max-startup-ms', type=float, help="exit with status 1 if a startup case's median is slower than this")
+    # Internal: run a single case in this process
+    parser.add_argument('--case-format', help=argparse.SUPPRESS)
+    parser.add_argument('--case-mode', help=argparse.SUPPRESS)
+    parser.add_argument('--media-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.case_format:
+        return case_main(args)
+    if args.startup:
+        return startup_main(args)
+
+    for tool in ('ffmpeg', 'ffprobe'):
+        if not shutil.which(tool):
+            print(f"{tool} is required to generate and convert the benchmark media.")
+            return 1
+
+    media_dir = tempfile.mkdtemp(prefix='streamflare-bench-media-')
+    try:
+        print("Generating test media...")
+        generate_media(media_dir, args.sources.split(','), args.duration, args.video_size, args.video_bitrate)
+        server = serve_media(media_dir)
+        results = []
+        for file_format in args.formats.split(','):
+            for mode in args.modes.split(','):
+                command = [sys.executable, os.path.abspath(__file__), '--case-format', file_format, '--case-mode', mode,
+                           '--media-dir', media_dir, '--port', str(server.server_port), '--links', str(args.links),
+                           '--workers', str(args.workers), '--connections', str(args.connections)]
+                case = subprocess.run(command, capture_output=True, text=True)
+                if case.returncode != 0:
+                    print(f"{file_format}/{mode} failed:\n{case.stderr}")
+                    continue
+                results.append(json.loads(case.stdout.strip().splitlines()[-1]))
+        server.shutdown()
+    finally:
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+def startup_main(args):
+    results = run_startup(args.startup_runs)
+    print_table(results, columns=('case', 'runs', 'min_ms', 'median_ms'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    slow = [result['case'] for result in results if args.max_startup_ms and result['median_ms'] > args.max_startup_ms]
+    if slow:
+        print(f"Startup slower than {args.max_startup_ms:g} ms: {', '.join(slow)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
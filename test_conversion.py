@@ -0,0 +1,48 @@
+"""Tests for the copy/encode decisions StreamFlareCore makes from CONTAINER_CODECS."""
+import pytest
+
+from StreamFlareCore import format_selector, plan_conversion
+
+@pytest.mark.parametrize('codecs, file_format, audio_only, args', [
+    # Compatible streams are copied
+    ({'video': 'h264', 'audio': 'aac'}, 'mp4', False, ['-map', '0:v:0', '-c:v', 'copy', '-map', '0:a:0', '-c:a', 'copy']),
+    ({'video': 'vp9', 'audio': 'opus'}, 'webm', False, ['-map', '0:v:0', '-c:v', 'copy', '-map', '0:a:0', '-c:a', 'copy']),
+    ({'video': 'vp9', 'audio': 'opus'}, 'mkv', False, ['-map', '0:v:0', '-c:v', 'copy', '-map', '0:a:0', '-c:a', 'copy']),
+    ({'audio': 'aac'}, 'm4a', False, ['-vn', '-map', '0:a:0', '-c:a', 'copy']),
+    # Only the stream that does not fit is re-encoded
+    ({'video': 'h264', 'audio': 'opus'}, 'mp4', False, ['-map', '0:v:0', '-c:v', 'copy', '-map', '0:a:0', '-c:a', 'aac', '-b:a', '192k']),
+    ({'video': 'vp9', 'audio': 'aac'}, 'mp4', False, ['-map', '0:v:0', '-c:v', 'libx264', '-map', '0:a:0', '-c:a', 'copy']),
+    # Audio targets drop the video stream
+    ({'video': 'h264', 'audio': 'mp3'}, 'mp3', True, ['-vn', '-map', '0:a:0', '-c:a', 'copy']),
+    ({'video': 'h264', 'audio': 'aac'}, 'mp3', True, ['-vn', '-map', '0:a:0', '-c:a', 'libmp3lame', '-b:a', '192k']),
+    # Lossless encoders get no bitrate
+    ({'audio': 'opus'}, 'flac', False, ['-vn', '-map', '0:a:0', '-c:a', 'flac']),
+    ({'audio': 'aac'}, 'wav', False, ['-vn', '-map', '0:a:0', '-c:a', 'pcm_s16le']),
+    # H.264/HEVC copied into AVI need Annex B start codes
+    ({'video': 'h264', 'audio': 'mp3'}, 'avi', False,
+     ['-map', '0:v:0', '-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb', '-map', '0:a:0', '-c:a', 'copy']),
+    ({'video': 'mpeg4', 'audio': 'aac'}, 'avi', False,
+     ['-map', '0:v:0', '-c:v', 'copy', '-map', '0:a:0', '-c:a', 'libmp3lame', '-b:a', '192k']),
+    ({'video': 'h264', 'audio': 'aac'}, 'mkv', False, ['-map', '0:v:0', '-c:v', 'copy', '-map', '0:a:0', '-c:a', 'copy']),
+])
+def test_plan_conversion(codecs, file_format, audio_only, args):
+    assert plan_conversion(codecs, file_format, audio_only) == args
+
+FORMATS = [
+    {'format_id': 'a-opus', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus'},
+    {'format_id': 'a-aac', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2'},
+    {'format_id': 'v-h264', 'ext': 'mp4', 'vcodec': 'avc1.64001F', 'acodec': 'none'},
+    {'format_id': 'v-vp9', 'ext': 'webm', 'vcodec': 'vp9', 'acodec': 'none'},
+]
+
+@pytest.mark.parametrize('file_format, formats, format_id, ext', [
+    ('m4a', FORMATS, 'a-aac', 'm4a'),
+    ('opus', FORMATS, 'a-opus', 'webm'),
+    ('mp4', FORMATS, 'v-h264+a-aac', 'mp4'),
+    ('webm', FORMATS, 'v-vp9+a-opus', 'webm'),
+    # Nothing fits avi's audio, so the streams are merged into mkv for conversion
+    ('avi', FORMATS, 'v-h264+a-aac', 'mkv'),
+])
+def test_format_selector(file_format, formats, format_id, ext):
+    selected = next(format_selector(file_format)({'formats': formats}))
+    assert (selected['format_id'], selected['ext']) == (format_id, ext)
@@ -0,0 +1,94 @@
+"""Tests for how StreamFlareCore classifies failures and which stages it retries."""
+import subprocess
+import sys
+
+import pytest
+import requests
+from yt_dlp.utils import DownloadCancelled, DownloadError, ExtractorError
+
+import StreamFlareCore
+from StreamFlareCore import (PERMANENT, RATE_LIMITED, TRANSIENT, ExpiredInfoError, JobMetrics, classify_error, retry_delay,
+                             retry_stage)
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(f"{status} Client Error", response=response)
+
+def download_error(cause):
+    """A yt-dlp DownloadError wrapping cause, the way YoutubeDL.download reports it."""
+    try:
+        raise cause
+    except Exception:
+        return DownloadError(f"ERROR: {cause}", sys.exc_info())
+
+@pytest.mark.parametrize('error, kind', [
+    (subprocess.CalledProcessError(1, ['ffmpeg', '-i', 'in.mkv', 'out.mp4']), PERMANENT),
+    (FileNotFoundError(2, 'No such file or directory', 'ffmpeg'), PERMANENT),
+    (FileNotFoundError(2, 'No such file or directory', 'ffprobe'), PERMANENT),
+    (http_error(429, {'Retry-After': '7'}), RATE_LIMITED),
+    (download_error(http_error(429)), RATE_LIMITED),
+    (DownloadError('ERROR: HTTP Error 429: Too Many Requests'), RATE_LIMITED),
+    (http_error(404), PERMANENT),
+    (http_error(403), TRANSIENT),
+    (http_error(503), TRANSIENT),
+    (ExtractorError('Private video. Sign in if you have been granted access', expected=True), PERMANENT),
+    (ExtractorError('Unable to download webpage: timed out'), TRANSIENT),
+    (requests.ConnectionError('Connection reset by peer'), TRANSIENT),
+    # A 404/410 is final for freshly extracted URLs, but cached ones have merely expired
+    (DownloadError('ERROR: unable to download video data: HTTP Error 404: Not Found'), PERMANENT),
+    (ExpiredInfoError('Cached stream URLs for x have expired: HTTP Error 404: Not Found'), TRANSIENT),
+    (ExpiredInfoError('Cached stream URLs for x have expired: HTTP Error 410: Gone'), TRANSIENT),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+def test_retry_after_is_honoured():
+    assert retry_delay(http_error(429, {'Retry-After': '7'}), RATE_LIMITED, 0) == 7
+
+class Flaky:
+    """Raise each of errors in turn, then return 'done'."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'done'
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(StreamFlareCore, 'retry_delay', lambda error, kind, attempt: 0)
+
+@pytest.mark.parametrize('errors, calls, retried', [
+    ((), 1, None),
+    ((requests.ConnectionError('reset'), http_error(429)), 3, 2),
+    ((ExpiredInfoError('Cached stream URLs for x have expired: HTTP Error 410: Gone'),), 2, 1),
+])
+def test_retry_stage_retries_transient_errors(errors, calls, retried):
+    func, metrics = Flaky(*errors), JobMetrics()
+    assert retry_stage('download', 3, func, metrics=metrics) == 'done'
+    assert func.calls == calls
+    assert metrics.retries.get('download') == retried
+
+@pytest.mark.parametrize('error', [
+    subprocess.CalledProcessError(1, ['ffmpeg']),
+    FileNotFoundError(2, 'No such file or directory', 'ffmpeg'),
+    ExtractorError('Video unavailable', expected=True),
+    DownloadCancelled('paused'),
+])
+def test_retry_stage_gives_up_at_once(error):
+    func = Flaky(error)
+    with pytest.raises(type(error)):
+        retry_stage('convert', 3, func)
+    assert func.calls == 1
+
+def test_retry_stage_stops_after_retries():
+    func = Flaky(*[requests.ConnectionError('reset')] * 5)
+    with pytest.raises(requests.ConnectionError):
+        retry_stage('download', 3, func)
+    assert func.calls == 3
@@ -0,0 +1,79 @@
+"""Tests for StreamFlareCore.segmented_download against benchmark's local Range-capable server."""
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import benchmark
+from StreamFlareCore import segmented_download
+
+CHUNK = 64 * 1024
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Plain static handler: ignores Range and always answers 200 with the whole file."""
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def media_dir(tmp_path):
+    media = tmp_path / 'media'
+    media.mkdir()
+    (media / 'clip.bin').write_bytes(os.urandom(10 * CHUNK + 123))
+    (media / 'empty.bin').write_bytes(b'')
+    return media
+
+@pytest.fixture
+def range_server(media_dir):
+    server = benchmark.serve_media(str(media_dir))
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def plain_server(media_dir):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(media_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+def test_full_download(range_server, media_dir, tmp_path):
+    dest = str(tmp_path / 'clip.bin')
+    progress = []
+    segmented_download(range_server + 'clip.bin', dest, connections=4, chunk_size=CHUNK, progress_hooks=[progress.append])
+    assert open(dest, 'rb').read() == (media_dir / 'clip.bin').read_bytes()
+    assert not os.path.exists(dest + '.segments.json')
+    assert progress[-1]['downloaded_bytes'] == progress[-1]['total_bytes'] == os.path.getsize(dest)
+
+def test_interrupted_download_resumes(range_server, media_dir, tmp_path):
+    dest = str(tmp_path / 'clip.bin')
+    url = range_server + 'clip.bin'
+
+    def interrupt(progress):
+        if progress['downloaded_bytes'] >= 3 * CHUNK:
+            raise IOError('connection dropped')
+
+    with pytest.raises(IOError, match='connection dropped'):
+        segmented_download(url, dest, connections=4, chunk_size=CHUNK, progress_hooks=[interrupt])
+    assert os.path.exists(dest + '.segments.json')
+
+    progress = []
+    segmented_download(url, dest, connections=4, chunk_size=CHUNK, progress_hooks=[progress.append])
+    assert progress[0]['downloaded_bytes'] >= 3 * CHUNK  # picked up where the first attempt stopped
+    assert open(dest, 'rb').read() == (media_dir / 'clip.bin').read_bytes()
+    assert not os.path.exists(dest + '.segments.json')
+
+def test_server_without_range_support(plain_server, media_dir, tmp_path):
+    dest = str(tmp_path / 'clip.bin')
+    segmented_download(plain_server + 'clip.bin', dest, connections=4, chunk_size=CHUNK)
+    assert open(dest, 'rb').read() == (media_dir / 'clip.bin').read_bytes()
+    assert not os.path.exists(dest + '.segments.json')
+
+def test_empty_resource(range_server, tmp_path):
+    dest = str(tmp_path / 'empty.bin')
+    segmented_download(range_server + 'empty.bin', dest, chunk_size=CHUNK)
+    assert os.path.getsize(dest) == 0
+    assert not os.path.exists(dest + '.segments.json')